@@ -0,0 +1,120 @@
+import time
+import asyncio
+import itertools
+
+# Snowflake-like IDs for fake Discord objects
+ids = itertools.count(1 << 40)
+
+# Status replies that don't count as the bot answering
+NOTICE_PREFIXES = ("Queued",)
+# Replies of admission control turning a message away
+REJECTION_PREFIXES = ("You're sending", "I'm busy")
+
+class FakeUser:
+    def __init__(self, name, bot=False):
+        self.id = next(ids)
+        self.name = name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+
+    def __str__(self):
+        return self.name
+
+    def mentioned_in(self, message):
+        return self.mention in message.content
+
+class FakeReference:
+    def __init__(self, message):
+        self.message_id = message.id
+        self.resolved = message
+        self.cached_message = message
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+class FakeMessage:
+    def __init__(self, channel, author, content, reference=None, attachments=()):
+        self.id = next(ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.reference = FakeReference(reference) if reference else None
+        self.attachments = list(attachments)
+        self.guild = channel.guild
+        self.mentions = []
+        self.channel_mentions = []
+        self.role_mentions = []
+        self.embeds = []
+        self.type = None
+        self.created = time.perf_counter()
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, reply_to=self, **kwargs)
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.api_latency)
+        self.content = content
+        self.channel.edits += 1
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.api_latency)
+        self.channel.messages.pop(self.id, None)
+
+class FakeChannel:
+    # Records what the bot sends, with a simulated Discord API round trip per call
+    def __init__(self, bot_user, guild=None, api_latency=0.0):
+        self.id = next(ids)
+        self.name = f"channel-{self.id}"
+        self.mention = f"<#{self.id}>"
+        self.guild = guild
+        self.bot_user = bot_user
+        self.api_latency = api_latency
+        self.messages = {}
+        self.first_reply = {}  # user message ID -> time the bot first answered it
+        self.rejected = set()  # user message IDs that were turned away
+        self.sends = 0
+        self.edits = 0
+
+    async def send(self, content=None, reply_to=None, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        message = FakeMessage(self, self.bot_user, content)
+        message.kwargs = kwargs
+        self.messages[message.id] = message
+        self.sends += 1
+        if reply_to is not None and (content or "").startswith(REJECTION_PREFIXES):
+            self.rejected.add(reply_to.id)
+        elif reply_to is not None and not (content or "").startswith(NOTICE_PREFIXES):
+            self.first_reply.setdefault(reply_to.id, time.perf_counter())
+        return message
+
+    async def fetch_message(self, message_id):
+        await asyncio.sleep(self.api_latency)
+        return self.messages[message_id]
+
+    def typing(self):
+        return FakeTyping()
+
+class FakeResponse:
+    async def defer(self, *args, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, author, api_latency=0.0, guild_id=None, channel_id=None):
+        self.author = author
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.response = FakeResponse()
+        self.api_latency = api_latency
+        self.created = time.perf_counter()
+        self.content = None
+        self.files = []
+
+    async def edit_original_response(self, content=None, files=None, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        self.content = content
+        if files:
+            self.files = files
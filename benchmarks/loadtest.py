@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tracemalloc
+
+# Add the project root to sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeUser, FakeChannel, FakeMessage, FakeInteraction
+from benchmarks.mock_backends import MockOllama, MockStableDiffusion, serve
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive the bot pipeline against mock Ollama and Stable Diffusion servers")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10, help="Messages per channel")
+    parser.add_argument("--interval", type=float, default=0.5, help="Mean seconds between messages in a channel")
+    parser.add_argument("--servers", type=int, default=2, help="Mock Ollama servers")
+    parser.add_argument("--latency", type=float, default=0.1, help="Ollama seconds to first token")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Ollama tokens per second")
+    parser.add_argument("--tokens", type=int, default=50, help="Tokens per answer")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Simulated Discord API round trip")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--text2img", type=int, default=0, help="Concurrent /text2img requests")
+    parser.add_argument("--sd-servers", type=int, default=1)
+    parser.add_argument("--sd-latency", type=float, default=0.2, help="Stable Diffusion seconds per image")
+    parser.add_argument("--port", type=int, default=18400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--metrics", action="store_true", help="Print the Prometheus metrics at the end")
+    return parser.parse_args()
+
+def configure(args):
+    # The bot reads its configuration at import time, so this has to run first
+    ollama_ports = [args.port + i for i in range(args.servers)]
+    sd_ports = [args.port + 100 + i for i in range(args.sd_servers)]
+    os.environ["OLLAMA"] = ",".join(f"http://127.0.0.1:{port}" for port in ollama_ports)
+    os.environ["STABLE_DIFFUSION"] = ",".join(f"http://127.0.0.1:{port}" for port in sd_ports)
+    os.environ["MODEL"] = "mock"
+    os.environ["STREAM"] = "true" if args.stream else os.environ.get("STREAM", "false")
+    os.environ.setdefault("HEALTH_CHECK_INTERVAL", "0")
+    return ollama_ports, sd_ports
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def report(name, latencies, elapsed):
+    print(f"{name}: {len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.1f}/s)")
+    if latencies:
+        print(f"  p50 {percentile(latencies, 50) * 1000:.0f}ms  p95 {percentile(latencies, 95) * 1000:.0f}ms  p99 {percentile(latencies, 99) * 1000:.0f}ms  max {max(latencies) * 1000:.0f}ms")
+
+async def run_chat(args, rng):
+    import src.bot as bot_module
+
+    bot_user = FakeUser("bot", bot=True)
+    bot_module.bot._connection.user = bot_user
+    channels = [FakeChannel(bot_user, api_latency=args.api_latency) for _ in range(args.channels)]
+    users = [FakeUser(f"user{i}") for i in range(args.channels * 2)]
+
+    # Completion is when the generation handling a message returns
+    finished = {}
+    generate = bot_module.generate
+
+    async def timed_generate(channel_id, jobs):
+        try:
+            await generate(channel_id, jobs)
+        finally:
+            now = time.perf_counter()
+            for job in jobs:
+                finished[job["message"].id] = now
+
+    bot_module.generate = timed_generate
+
+    sent = []
+
+    async def drive(channel):
+        for i in range(args.messages):
+            await asyncio.sleep(rng.expovariate(1 / args.interval) if args.interval > 0 else 0)
+            message = FakeMessage(channel, rng.choice(users), f"Question {i} in {channel.name}: what about {rng.random()}?")
+            sent.append(message)
+            await bot_module.on_message(message)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(drive(channel) for channel in channels))
+    rejected = lambda: sum(len(c.rejected) for c in channels)
+    while len(finished) + rejected() < len(sent):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    bot_module.generate = generate
+
+    report("chat end-to-end", [finished[m.id] - m.created for m in sent if m.id in finished], elapsed)
+    if rejected():
+        print(f"  rejected: {rejected()} of {len(sent)}")
+    first = [c.first_reply[m.id] - m.created for c in channels for m in sent if m.id in c.first_reply]
+    if first:
+        print(f"  time to first reply: p50 {percentile(first, 50) * 1000:.0f}ms  p95 {percentile(first, 95) * 1000:.0f}ms  p99 {percentile(first, 99) * 1000:.0f}ms")
+    print(f"  Discord calls: {sum(c.sends for c in channels)} sends, {sum(c.edits for c in channels)} edits")
+
+async def run_text2img(args, rng):
+    from src.cogs.text2img import Text2Img
+
+    cog = Text2Img(None)
+    users = [FakeUser(f"artist{i}") for i in range(max(args.text2img // 2, 1))]
+    prompts = ["a cat", "a dog", "a castle", "a forest"]
+
+    async def request(i):
+        inter = FakeInteraction(rng.choice(users), api_latency=args.api_latency)
+        await Text2Img.text2img.callback(cog, inter, rng.choice(prompts), 256, 256, 10, 1, 1, False, -1)
+        return time.perf_counter() - inter.created
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(request(i) for i in range(args.text2img)))
+    report("text2img end-to-end", latencies, time.perf_counter() - start)
+    cog.cog_unload()
+
+async def main():
+    args = parse_args()
+    ollama_ports, sd_ports = configure(args)
+    rng = random.Random(args.seed)
+
+    ollama = [MockOllama(args.latency, args.token_rate, args.tokens, args.failure_rate, seed=args.seed + i) for i in range(len(ollama_ports))]
+    sd = [MockStableDiffusion(args.sd_latency, args.failure_rate, seed=args.seed + i) for i in range(len(sd_ports))]
+    runners = [await serve(mock.app(), port) for mock, port in zip(ollama + sd, ollama_ports + sd_ports)]
+
+    # Imported before tracing starts so module setup doesn't count as growth
+    import src.bot
+    import src.cogs.text2img
+    from src.utils import open_sessions, close_sessions
+    await open_sessions()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        if args.messages and args.channels:
+            await run_chat(args, rng)
+            print(f"  Ollama requests: {sum(m.requests for m in ollama)}, injected failures: {sum(m.failures for m in ollama)}")
+        if args.text2img:
+            await run_text2img(args, rng)
+            print(f"  Stable Diffusion requests: {sum(m.requests for m in sd)}")
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"memory: +{(current - baseline) / 1024 / 1024:.1f} MiB retained, {peak / 1024 / 1024:.1f} MiB peak traced, {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB max RSS")
+        if args.metrics:
+            from src.metrics import render
+            print(render())
+        await close_sessions()
+        for runner in runners:
+            await runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+import json
+import base64
+import random
+import asyncio
+import hashlib
+from aiohttp import web
+
+class MockOllama:
+    # Stand-in for an Ollama server with configurable latency, token rate and failure injection
+    def __init__(self, latency=0.05, token_rate=200.0, tokens=50, failure_rate=0.0, context_length=4096, seed=0):
+        self.latency = latency  # Seconds before the first token
+        self.token_rate = token_rate  # Tokens per second after that
+        self.tokens = tokens
+        self.failure_rate = failure_rate
+        self.context_length = context_length
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/generate", self.generate)
+        app.router.add_post("/api/chat", self.generate)
+        app.router.add_post("/api/show", self.show)
+        app.router.add_post("/api/embeddings", self.embeddings)
+        app.router.add_get("/api/version", self.version)
+        app.router.add_get("/api/ps", self.ps)
+        return app
+
+    def _fail(self):
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+    def _final(self, data, chat):
+        final = {
+            "done": True,
+            "prompt_eval_count": len(data.get("context") or []) + 10,
+            "eval_count": self.tokens,
+            "eval_duration": int(self.tokens / self.token_rate * 1e9)
+        }
+        if not chat:
+            final["context"] = (data.get("context") or []) + list(range(self.tokens))
+        return final
+
+    def _chunk(self, text, chat):
+        if chat:
+            return {"message": {"role": "assistant", "content": text}, "done": False}
+        return {"response": text, "done": False}
+
+    async def generate(self, request):
+        self.requests += 1
+        data = await request.json()
+        chat = request.path.endswith("/chat")
+        await asyncio.sleep(self.latency)
+        if self._fail():
+            return web.json_response({"error": "injected failure"}, status=500)
+
+        words = [f"word{i}" for i in range(self.tokens)]
+        if not data.get("stream", True):
+            await asyncio.sleep(self.tokens / self.token_rate)
+            response = self._final(data, chat)
+            response.update(self._chunk(" ".join(words), chat))
+            response["done"] = True
+            return web.json_response(response)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for word in words:
+            await asyncio.sleep(1 / self.token_rate)
+            await response.write((json.dumps(self._chunk(word + " ", chat)) + "\n").encode())
+        await response.write((json.dumps(self._final(data, chat)) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def show(self, request):
+        return web.json_response({
+            "system": "",
+            "parameters": "",
+            "model_info": {"llama.context_length": self.context_length}
+        })
+
+    async def embeddings(self, request):
+        data = await request.json()
+        digest = hashlib.sha256(data.get("prompt", "").encode()).digest()
+        return web.json_response({"embedding": [b / 255 for b in digest]})
+
+    async def version(self, request):
+        return web.json_response({"version": "mock"})
+
+    async def ps(self, request):
+        return web.json_response({"models": []})
+
+class MockStableDiffusion:
+    # Stand-in for an AUTOMATIC1111 server
+    def __init__(self, latency=0.5, failure_rate=0.0, image_bytes=64 * 1024, seed=0):
+        self.latency = latency  # Seconds per image
+        self.failure_rate = failure_rate
+        self.image = bytes(image_bytes)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.interrupts = 0
+        self.interrupted = False
+        self.progress = 0.0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/sdapi/v1/txt2img", self.txt2img)
+        app.router.add_get("/sdapi/v1/progress", self.get_progress)
+        app.router.add_post("/sdapi/v1/interrupt", self.interrupt)
+        app.router.add_get("/sdapi/v1/options", self.options)
+        app.router.add_get("/internal/ping", self.ping)
+        return app
+
+    async def txt2img(self, request):
+        self.requests += 1
+        data = await request.json()
+        count = data.get("batch_size", 1) * data.get("batch_count", 1)
+        steps = 10
+        self.interrupted = False
+        for step in range(steps):
+            if self.interrupted:
+                # Like AUTOMATIC1111, an interrupted render returns early
+                count = 0
+                break
+            self.progress = step / steps
+            await asyncio.sleep(self.latency * count / steps)
+        self.progress = 0.0
+        if self.random.random() < self.failure_rate:
+            return web.json_response({"error": "injected failure"}, status=500)
+        image = base64.b64encode(self.image).decode()
+        return web.json_response({"images": [image] * count})
+
+    async def interrupt(self, request):
+        self.interrupts += 1
+        self.interrupted = True
+        return web.json_response({})
+
+    async def get_progress(self, request):
+        return web.json_response({"progress": self.progress, "eta_relative": (1 - self.progress) * self.latency})
+
+    async def options(self, request):
+        return web.json_response({"sd_model_checkpoint": "mock.safetensors"})
+
+    async def ping(self, request):
+        return web.json_response({})
+
+async def serve(app, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import random
+import string
+
+# Add the project root to sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils import split_text, FENCE_PATTERN
+
+LIMIT = 2000
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024]
+
+def random_word(rng):
+    roll = rng.random()
+    if roll < 0.01:
+        # URLs and other words that don't fit into a single message
+        return "https://example.com/" + "".join(rng.choices(string.ascii_letters, k=rng.randint(100, 5000)))
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 12)))
+
+def random_text(rng, size, code=True):
+    parts = []
+    total = 0
+    while total < size:
+        roll = rng.random()
+        if code and roll < 0.05:
+            body = "\n".join("    " + " ".join(random_word(rng) for _ in range(rng.randint(1, 15))) for _ in range(rng.randint(1, 200)))
+            part = f"```python\n{body}\n```"
+        elif roll < 0.15:
+            part = "\n\n"
+        elif roll < 0.3:
+            part = "\n"
+        else:
+            part = random_word(rng) + " "
+        parts.append(part)
+        total += len(part)
+    return "".join(parts)
+
+def content(text):
+    # Non-whitespace characters outside of fence lines, which the splitter may add
+    return "".join("".join(line.split()) for line in text.split("\n") if not FENCE_PATTERN.match(line))
+
+def check(text, segments):
+    # Properties every split has to satisfy
+    assert all(segments), "empty segment"
+    assert all(len(segment) <= LIMIT for segment in segments), "segment over the limit"
+    for segment in segments:
+        fences = sum(1 for line in segment.split("\n") if FENCE_PATTERN.match(line))
+        assert fences % 2 == 0, "code block left open across messages"
+    # Nothing but whitespace and fences may be lost or added
+    assert content(text) == content("\n".join(segments)), "content changed"
+
+def main():
+    rng = random.Random(int(os.getenv("SEED", "0")))
+    print(f"{'input':>10} {'code':>5} {'segments':>9} {'time':>10} {'throughput':>14}")
+    for size in SIZES:
+        for code in (False, True):
+            text = random_text(rng, size, code)
+            start = time.perf_counter()
+            segments = split_text(text, LIMIT)
+            elapsed = time.perf_counter() - start
+            check(text, segments)
+            print(f"{len(text):>10} {str(code):>5} {len(segments):>9} {elapsed * 1000:>8.2f}ms {len(text) / elapsed / 1e6:>10.1f} MB/s")
+
+    # Many small random inputs for the properties, including edge cases around the limit
+    for _ in range(int(os.getenv("CASES", "500"))):
+        code = rng.random() < 0.5
+        text = random_text(rng, rng.randint(1, 3 * LIMIT), code)
+        check(text, split_text(text, LIMIT))
+    print("Properties hold")
+
+if __name__ == "__main__":
+    main()
@@ -5,5 +5,15 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 if __name__ == "__main__":
-    from src.bot import bot, TOKEN
-    bot.run(TOKEN)
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # CLUSTER_WORKERS > 1 runs a launcher that starts this script again once per shard range
+    workers = int(os.getenv("CLUSTER_WORKERS", "1"))
+    if workers > 1 and not os.getenv("SHARD_IDS"):
+        import asyncio
+        from src.cluster import run_cluster
+        asyncio.run(run_cluster(workers, os.path.abspath(__file__)))
+    else:
+        from src.bot import bot, TOKEN
+        bot.run(TOKEN)
@@ -0,0 +1,125 @@
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+SCOPES = ("user", "guild", "global")
+
+def parse_quotas(spec):
+    # "user=5/60,guild=30/60,global=100/60": requests per seconds for each scope, unset scopes are unlimited
+    quotas = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        scope, limit = part.split("=", 1)
+        count, seconds = limit.split("/", 1)
+        if scope.strip() not in SCOPES:
+            raise ValueError(f"Unknown quota scope {scope!r}, expected one of {', '.join(SCOPES)}")
+        quotas[scope.strip()] = (float(count), float(seconds))
+    return quotas
+
+def parse_weights(spec):
+    # "123456789=2,987654321=0.5": relative share of the backends per guild, 1 by default
+    weights = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            guild_id, weight = part.split("=", 1)
+            weights[int(guild_id)] = float(weight)
+    return weights
+
+class Quotas:
+    # Token buckets per user, per guild and global; a request is admitted only when every bucket it
+    # falls under has a token, and then takes one from each
+    def __init__(self, quotas):
+        self.quotas = quotas  # scope -> (count, seconds)
+        self.buckets = {}  # (scope, key) -> [tokens, last refill]
+
+    def admit(self, user_id, guild_id):
+        # Returns 0 when admitted, otherwise the seconds until the request would be
+        now = time.monotonic()
+        keys = [(scope, key) for scope, key in (("user", user_id), ("guild", guild_id), ("global", None))
+                if scope in self.quotas and (key is not None or scope == "global")]
+        buckets = [self._bucket(key, now) for key in keys]
+        wait = 0.0
+        for (scope, _), bucket in zip(keys, buckets):
+            count, seconds = self.quotas[scope]
+            if bucket[0] < 1:
+                wait = max(wait, (1 - bucket[0]) * seconds / count)
+        if wait > 0:
+            return wait
+        for bucket in buckets:
+            bucket[0] -= 1
+        return 0.0
+
+    def _bucket(self, key, now):
+        count, seconds = self.quotas[key[0]]
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= 4096:
+                self._prune(now)
+            bucket = self.buckets[key] = [count, now]
+        bucket[0] = min(count, bucket[0] + (now - bucket[1]) * count / seconds)
+        bucket[1] = now
+        return bucket
+
+    def _prune(self, now):
+        # Buckets that would be full again hold nothing worth remembering
+        for key, (tokens, updated) in list(self.buckets.items()):
+            count, seconds = self.quotas[key[0]]
+            if tokens + (now - updated) * count / seconds >= count:
+                del self.buckets[key]
+
+class FairQueue:
+    # Weighted fair queuing in front of the backends: while every slot is busy, the next one goes to the
+    # waiter with the smallest virtual finish time, so a busy guild gets its share but can't starve the rest
+    def __init__(self, capacity, weights=None):
+        self.capacity = max(capacity, 1)
+        self.weights = weights or {}
+        self.running = 0
+        self.waiting = []  # Heap of (finish tag, sequence, future)
+        self.finish = {}  # group -> finish tag of its latest request
+        self.virtual = 0.0  # Finish tag of the request that started last
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return sum(1 for _, _, future in self.waiting if not future.done())
+
+    async def acquire(self, group):
+        tag = max(self.virtual, self.finish.get(group, 0.0)) + 1 / self.weights.get(group, 1.0)
+        self.finish[group] = tag
+        if len(self.finish) > 4096:
+            # Groups that fell behind the virtual clock would restart from it anyway
+            self.finish = {g: t for g, t in self.finish.items() if t > self.virtual}
+        if self.running < self.capacity and not len(self):
+            self.running += 1
+            self.virtual = tag
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (tag, next(self.sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Handed a slot just before being cancelled: pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.running -= 1
+        while self.waiting and self.running < self.capacity:
+            tag, _, future = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            self.running += 1
+            self.virtual = tag
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, group):
+        await self.acquire(group)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,118 @@
+import codecs
+import asyncio
+import logging
+from collections import OrderedDict
+
+try:
+    from charset_normalizer import from_bytes
+except ImportError:
+    from_bytes = None
+
+logger = logging.getLogger("Bot")
+
+CHUNK_SIZE = 64 * 1024
+
+def is_text_attachment(att):
+    return bool(att.content_type and att.content_type.startswith("text"))
+
+def content_type_charset(content_type):
+    for param in (content_type or "").split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "charset" and value:
+            return value.strip('"')
+    return None
+
+def decode(raw, charset, truncated):
+    # A capped read can end in the middle of a multi-byte character, so decode incrementally
+    for candidate in (charset, "utf-8"):
+        if not candidate:
+            continue
+        try:
+            return codecs.getincrementaldecoder(candidate)().decode(raw, final=not truncated)
+        except (LookupError, UnicodeDecodeError):
+            pass
+    if from_bytes is not None:
+        match = from_bytes(raw).best()
+        if match is not None:
+            return str(match)
+    return raw.decode("latin-1")
+
+class AttachmentCache:
+    # Decoded attachment text by attachment ID, LRU bounded by total characters
+    def __init__(self, max_chars=16 * 1024 * 1024):
+        self.max_chars = max_chars
+        self.entries = OrderedDict()  # id -> (text, truncated)
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[0])
+        self.entries[key] = entry
+        self.size += len(entry[0])
+        while self.size > self.max_chars and self.entries:
+            _, (text, _) = self.entries.popitem(last=False)
+            self.size -= len(text)
+
+class AttachmentReader:
+    def __init__(self, session_factory, max_bytes=1024 * 1024, cache_chars=16 * 1024 * 1024):
+        self.session_factory = session_factory
+        self.max_bytes = max_bytes
+        self.cache = AttachmentCache(cache_chars)
+        self.downloads = {}  # id -> Task, so concurrent requests for one file share the download
+
+    async def _download(self, att):
+        raw = bytearray()
+        truncated = False
+        async with self.session_factory().get(att.url) as resp:
+            resp.raise_for_status()
+            charset = resp.charset or content_type_charset(att.content_type)
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                raw += chunk
+                if len(raw) > self.max_bytes:
+                    del raw[self.max_bytes:]
+                    truncated = True
+                    break
+        return decode(bytes(raw), charset, truncated), truncated
+
+    async def read(self, att):
+        # Returns (text, truncated), reusing earlier downloads of the same attachment
+        entry = self.cache.get(att.id)
+        if entry is not None:
+            return entry
+        task = self.downloads.get(att.id)
+        if task is None:
+            task = self.downloads[att.id] = asyncio.ensure_future(self._download(att))
+            task.add_done_callback(lambda _: self.downloads.pop(att.id, None))
+        # Shielded so one cancelled reader doesn't abort the download for the others
+        entry = await asyncio.shield(task)
+        self.cache.put(att.id, entry)
+        return entry
+
+    async def ingest(self, attachments, max_chars):
+        # Downloads all text attachments at once and fits them into max_chars in total;
+        # returns the prompt text and notes about anything that was cut
+        texts = await asyncio.gather(*(self.read(att) for att in attachments))
+        # Water-filling: the smallest files are served first and leave their unused share to larger ones
+        shares = {}
+        remaining = max_chars
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i][0]))
+        for n, i in enumerate(order):
+            shares[i] = min(len(texts[i][0]), remaining // (len(order) - n))
+            remaining -= shares[i]
+
+        notes = []
+        parts = []
+        for i, (att, (text, truncated)) in enumerate(zip(attachments, texts)):
+            if len(text) > shares[i]:
+                notes.append(f"`{att.filename}` was cut to {shares[i]:,} of {len(text):,} characters to fit the prompt")
+                text = text[:shares[i]] + "\n[...]"
+            elif truncated:
+                notes.append(f"`{att.filename}` is larger than {self.max_bytes:,} bytes, only the beginning was read")
+            parts.append(f"\n{i + 1}. File - {att.filename}:\n{text}")
+        return "".join(parts), notes
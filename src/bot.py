@@ -6,24 +6,57 @@ if __name__ == "__main__" and __package__ is None:
     sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     __package__ = "src"
 
-import json
 import re
+import math
+import time
 import asyncio
 import datetime
 import logging
-import aiohttp
 import disnake
+from collections import OrderedDict
+from contextlib import aclosing
 from disnake.ext import commands
 from dotenv import load_dotenv
+from . import metrics
+from . import offload
+from .streaming import StreamingReply
+from .outbound import Outbound, SendQueue
+from .cluster import parse_shard_ids
+from .admission import Quotas, FairQueue, parse_quotas, parse_weights
+from .context_store import ContextStore
+from .channel_queue import ChannelQueue, merge_inputs
+from .response_cache import ResponseCache
+from .memory import ChannelMemory
+from .attachments import AttachmentReader, is_text_attachment
+from .history import (
+    parse_budgets, 
+    context_window, 
+    message_tokens, 
+    estimate_tokens, 
+    fit_history, 
+    truncate_context, 
+    is_summary, 
+    summary_prompt, 
+    summary_message
+)
 from .utils import (
     make_request, 
-    split_text, 
+    stream_request, 
+    get_embedding, 
+    get_session, 
+    open_sessions, 
+    close_sessions, 
+    start_health_checks, 
+    preload_models, 
+    stop_health_checks, 
     get_boolean, 
     log_error, 
     logger, 
+    ollama_pool, 
     CHANNELS, 
     MODEL,
-    RANDOM_SERVER
+    RANDOM_SERVER,
+    SCHEDULER_ADDRESS
 )
 
 load_dotenv()
@@ -37,6 +70,31 @@ SHOW_START_OF_CONVERSATION = get_boolean(os.getenv("SHOW_START_OF_CONVERSATION")
 INITIAL_PROMPT = os.getenv("INITIAL_PROMPT")
 USE_INITIAL_PROMPT = get_boolean(os.getenv("USE_INITIAL_PROMPT"))
 REQUIRES_MENTION = get_boolean(os.getenv("REQUIRES_MENTION"))
+STREAM = get_boolean(os.getenv("STREAM"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))
+COALESCE_MAX = int(os.getenv("COALESCE_MAX", "4"))
+CONTEXT_MODE = os.getenv("CONTEXT_MODE", "context").lower()  # "context" (opaque tokens) or "chat" (message history)
+CONTEXT_BUDGETS = parse_budgets(os.getenv("CONTEXT_TOKENS"))
+CONTEXT_RESERVE = int(os.getenv("CONTEXT_RESERVE", "512"))
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "4"))
+CONTEXT_SUMMARIZE = get_boolean(os.getenv("CONTEXT_SUMMARIZE"))
+RESPONSE_CACHE = get_boolean(os.getenv("RESPONSE_CACHE"))
+RESPONSE_CACHE_EMBED_MODEL = os.getenv("RESPONSE_CACHE_EMBED_MODEL")
+MEMORY = get_boolean(os.getenv("MEMORY"))
+MEMORY_EMBED_MODEL = os.getenv("MEMORY_EMBED_MODEL") or RESPONSE_CACHE_EMBED_MODEL
+ATTACHMENT_TOKENS = int(os.getenv("ATTACHMENT_TOKENS", "2000"))
+REPLY_MODE = os.getenv("REPLY_MODE", "split").lower()  # "split", "embed", "file" or "pages"
+REPLY_MAX_CALLS = int(os.getenv("REPLY_MAX_CALLS", "5"))  # Streamed answers are capped at this many messages, always "split"
+MAX_PENDING = int(os.getenv("MAX_PENDING", "100"))  # Waiting chat generations before new ones are turned away
+PARTIAL_REPLIES = os.getenv("PARTIAL_REPLIES", "keep").lower()  # "keep" or "discard" what a stopped generation streamed
+SUPERSEDE = get_boolean(os.getenv("SUPERSEDE"))  # A newer message restarts its author's running generation with both
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS"))  # Set per worker in cluster mode
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+OLLAMA_PRELOAD = [m.strip() for m in os.getenv("OLLAMA_PRELOAD", "").split(",") if m.strip()]
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the Prometheus endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))  # Seconds, 0 disables the watchdog
 
 def parse_json_message(s):
     try:
@@ -67,27 +125,292 @@ intents = disnake.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.AutoShardedBot(
+class Bot(commands.AutoShardedBot):
+    async def start(self, *args, **kwargs):
+        # HTTP pools live for the whole lifetime of the bot
+        await open_sessions()
+        start_health_checks()
+        if LOOP_STALL_THRESHOLD > 0:
+            metrics.start_watchdog(LOOP_STALL_THRESHOLD)
+        await offload.start()
+        if OLLAMA_PRELOAD and not SCHEDULER_ADDRESS:
+            # In cluster mode the launcher owns the servers and preloads them
+            task = asyncio.create_task(preload_models(OLLAMA_PRELOAD))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        if METRICS_PORT:
+            await metrics.start_metrics(METRICS_HOST, METRICS_PORT)
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        stop_health_checks()
+        metrics.stop_watchdog()
+        # Conversations still queued for the disk go out before the threads stop
+        contexts.close()
+        offload.shutdown()
+        await metrics.stop_metrics()
+        await close_sessions()
+
+bot = Bot(
     command_prefix=commands.when_mentioned, # We handle text commands manually in on_message
     intents=intents,
-    help_command=None
+    help_command=None,
+    shard_ids=SHARD_IDS,
+    shard_count=SHARD_COUNT
 )
 
 # State
-messages = {} # {channel_id: {amount: int, last: context}}
-model_info = None
+contexts = ContextStore(
+    memory_budget=int(os.getenv("CONTEXT_MEMORY_BUDGET", str(64 * 1024 * 1024))),
+    ttl=float(os.getenv("CONTEXT_TTL", "3600")),
+    path=os.getenv("CONTEXT_DB") or None,
+    disk_max_age=float(os.getenv("CONTEXT_DB_MAX_AGE", str(30 * 24 * 3600))),
+    busy_timeout=float(os.getenv("CONTEXT_DB_BUSY_TIMEOUT", "0.5"))
+)
+# generate() is defined further down, so resolve it lazily
+channel_queue = ChannelQueue(lambda channel_id, jobs: generate(channel_id, jobs), COALESCE_WINDOW, COALESCE_MAX)
+response_cache = None
+if RESPONSE_CACHE:
+    response_cache = ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1000")),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "86400")),
+        threshold=float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95")),
+        embed=(lambda text: get_embedding(RESPONSE_CACHE_EMBED_MODEL, text)) if RESPONSE_CACHE_EMBED_MODEL else None
+    )
+memory = None
+if MEMORY:
+    if MEMORY_EMBED_MODEL:
+        memory = ChannelMemory(
+            os.getenv("MEMORY_DIR", "memory"),
+            lambda text: get_embedding(MEMORY_EMBED_MODEL, text),
+            top_k=int(os.getenv("MEMORY_TOP_K", "3")),
+            min_score=float(os.getenv("MEMORY_MIN_SCORE", "0.5")),
+            max_chars=int(os.getenv("MEMORY_SNIPPET_CHARS", "1000"))
+        )
+    else:
+        logger.warning("MEMORY is on but neither MEMORY_EMBED_MODEL nor RESPONSE_CACHE_EMBED_MODEL is set, channel memory is disabled")
+# Channels that opted out of the response cache
+uncached_channels = {int(c) for c in os.getenv("RESPONSE_CACHE_EXCLUDE", "").split(",") if c.strip()}
+attachment_reader = AttachmentReader(
+    lambda: get_session("discord"),
+    max_bytes=int(os.getenv("ATTACHMENT_MAX_BYTES", str(1024 * 1024))),
+    cache_chars=int(os.getenv("ATTACHMENT_CACHE_CHARS", str(16 * 1024 * 1024)))
+)
+send_queue = SendQueue(
+    rate=float(os.getenv("SEND_RATE", "1.0")),
+    burst=int(os.getenv("SEND_BURST", "5"))
+)
+outbound = Outbound(REPLY_MODE, REPLY_MAX_CALLS, send_queue, page_timeout=float(os.getenv("REPLY_PAGE_TIMEOUT", "900")))
+# Admission: per user/guild/global rate limits, then a bounded wait for a fair share of the backends
+chat_quotas = Quotas(parse_quotas(os.getenv("CHAT_QUOTAS")))
+fair_queue = FairQueue(
+    sum(server.slots for server in ollama_pool.servers),
+    parse_weights(os.getenv("GUILD_WEIGHTS"))
+)
+model_infos = {}  # Model -> /api/show response
+channel_models = {}  # Channel ID -> model picked with .model
+channel_servers = OrderedDict()  # Channel ID -> URL of the server that answered last
+background_tasks = set()
+
+metrics.context_store_turns.collect = lambda: {(): len(contexts)}
+metrics.context_store_bytes.collect = lambda: {(): contexts.size}
+
+# Text commands counted under their own name, anything else as "unknown"
+TEXT_COMMANDS = {"reset", "clear", "stop", "help", "?", "h", "cache", "model", "system", "ping", "forget"}
 
 async def reply_split_message(message, content):
-    response_messages = split_text(content, 2000)
-    sent_messages = []
+    # Long answers go out according to REPLY_MODE, paced per channel
+    return await outbound.reply(message, content)
+
+async def send_reply(message, content):
+    # Short replies (notices, command answers) are paced along with the answers in the channel
+    return await send_queue.run(message.channel.id, "send", lambda: message.reply(content))
+
+def model_for(channel_id):
+    return channel_models.get(channel_id, MODEL)
+
+def remember_server(channel_id, server):
+    # Follow-up turns prefer this server, bounded like any other per-channel cache
+    channel_servers[channel_id] = server.url
+    channel_servers.move_to_end(channel_id)
+    if len(channel_servers) > 10000:
+        channel_servers.popitem(last=False)
+
+async def cancel_jobs(channel_id, reason, message_ids=None):
+    # Drops queued messages and aborts a generation nobody waits for anymore, its backend request is
+    # closed (Ollama stops generating) and its slot freed as the task unwinds
+    jobs = channel_queue.cancel(channel_id, message_ids)
+    if jobs:
+        metrics.cancellations.inc(len(jobs), command="chat", reason=reason)
+    for job in jobs:
+        if job.get("notice"):
+            try:
+                await send_queue.run(channel_id, "delete", job["notice"].delete)
+            except disnake.HTTPException:
+                pass
+    return jobs
+
+async def get_model_info(model):
+    # Fetch model info if needed
+    if model not in model_infos:
+        try:
+            info = await make_request("/api/show", "post", {"name": model})
+            if isinstance(info, str):
+                info = offload.loads(info)
+            if isinstance(info, dict) and not info.get("error"):
+                model_infos[model] = info
+        except Exception as e:
+            logger.error(f"Failed to fetch model info of {model}")
+            log_error(e)
+    return model_infos.get(model)
+
+async def get_system_message(model=MODEL):
+    model_info = await get_model_info(model)
+            
+    # Prepare system message
+    system_messages = []
+    if USE_MODEL_SYSTEM and model_info and model_info.get("system"):
+        system_messages.append(model_info["system"])
+    if use_custom_system_message:
+        system_messages.append(custom_system_message)
+        
+    return "\n\n".join(system_messages)
+
+def response_text_of(obj):
+    # /api/generate streams "response", /api/chat streams "message.content"
+    if "message" in obj:
+        return obj["message"].get("content", "")
+    return obj.get("response", "")
+
+async def complete_reply(message, prefix, path, payload):
+    start = time.monotonic()
+    channel_id = message.channel.id
+    response_data = await make_request(path, "post", payload, channel_servers.get(channel_id), lambda server: remember_server(channel_id, server))
+    elapsed = time.monotonic() - start
     
-    for i, text in enumerate(response_messages):
-        if i == 0:
-            sent_messages.append(await message.reply(text))
-        else:
-            sent_messages.append(await message.channel.send(text))
+    response_objs = []
+    if isinstance(response_data, str):
+        # It's a stream of JSONs (fallback if stream=False is ignored or fails)
+        lines = response_data.strip().split("\n")
+        for line in lines:
+            if line.strip():
+                try:
+                    response_objs.append(offload.loads(line))
+                except Exception as e:
+                    logger.warning(f"Failed to parse JSON line: {line} - Error: {e}")
+    elif isinstance(response_data, dict):
+        response_objs.append(response_data)
+    else:
+        logger.warning(f"Unexpected response type: {type(response_data)}")
+        
+    # Without streaming the first token is only visible through Ollama's own timing of the rest
+    for r in response_objs:
+        if r.get("done") and r.get("eval_duration"):
+            metrics.time_to_first_token.observe(max(elapsed - r["eval_duration"] / 1e9, 0.0), model=payload["model"])
             
-    return sent_messages
+    response_text = "".join([response_text_of(r) for r in response_objs])
+    if not response_text:
+        logger.warning(f"Empty response text. Raw data: {response_data}")
+        response_text = "(No response)"
+        
+    logger.debug(f"Response: {response_text}")
+    
+    reply_msgs = await reply_split_message(message, prefix + response_text)
+    return response_objs, reply_msgs, response_text
+
+async def stream_reply(message, prefix, path, payload):
+    reply = StreamingReply(message, prefix, 2000, STREAM_EDIT_INTERVAL, send_queue, max(REPLY_MAX_CALLS, 1))
+    response_objs = []
+    response_text = ""
+    start = time.monotonic()
+    
+    channel_id = message.channel.id
+    try:
+        # Closed on the way out, so a generation stopped between tokens doesn't leave its request running
+        async with aclosing(stream_request(path, "post", payload, channel_servers.get(channel_id), lambda server: remember_server(channel_id, server))) as stream:
+            async for obj in stream:
+                if obj.get("error"):
+                    raise Exception(obj["error"])
+                token = response_text_of(obj)
+                if token:
+                    if not response_text:
+                        metrics.time_to_first_token.observe(time.monotonic() - start, model=payload["model"])
+                    response_text += token
+                    await reply.feed(token)
+                # Only the final object carries the context, no need to keep every token
+                if obj.get("done"):
+                    response_objs.append(obj)
+    except asyncio.CancelledError:
+        # Stopped, superseded or its messages deleted
+        try:
+            await reply.abort(PARTIAL_REPLIES != "discard")
+        except Exception as e:
+            logger.debug(f"Failed to clean up a stopped reply: {e}")
+        raise
+            
+    logger.debug(f"Response: {response_text}")
+    
+    reply_msgs = await reply.finish()
+    return response_objs, reply_msgs, response_text
+
+async def summarize(channel_id, turn_id, history, dropped):
+    # Folds the turns that fell out of the budget into a summary at the start of the stored history
+    summary = history[0] if history and is_summary(history[0]) else None
+    try:
+        response = await make_request("/api/generate", "post", {
+            "model": model_for(channel_id),
+            "prompt": summary_prompt(summary, dropped),
+            "stream": False
+        })
+        text = response.get("response", "") if isinstance(response, dict) else ""
+        if text.strip():
+            contexts.update_turn(channel_id, turn_id, [summary_message(text)] + [m for m in history if not is_summary(m)])
+            logger.debug(f"Summarized {len(dropped)} messages in {channel_id}")
+    except Exception as e:
+        logger.error("Failed to summarize conversation")
+        log_error(e)
+
+def recent_turns(channel_id, turn_id, count):
+    # The last count turns of the branch ending at turn_id, their exchanges are still in the prompt
+    turns = set()
+    while turn_id is not None and len(turns) < count:
+        turns.add(turn_id)
+        turn_id = contexts.parent(channel_id, turn_id)
+    return turns
+
+def memory_prompt(memories):
+    return "Earlier in this channel:\n\n" + "\n\n".join(memories)
+
+def memory_text(jobs, question, answer):
+    # merge_inputs already names the authors when there were several
+    if len({job["message"].author.id for job in jobs}) == 1:
+        question = f"{jobs[0]['message'].author.name}: {question}"
+    return f"{question}\nAssistant: {answer}"
+
+async def resolve_reference(message):
+    # Returns the ID of the bot reply being continued, or the text attachments of a replied-to user message.
+    # Avoids the REST call where possible: our own replies are in the context index, Discord usually
+    # sends the referenced message along and the client may still have it cached
+    reference = message.reference
+    if contexts.turn_of(message.channel.id, reference.message_id) is not None:
+        metrics.reference_lookups.inc(source="index")
+        return reference.message_id, []
+    reply = reference.resolved or reference.cached_message
+    if isinstance(reply, disnake.DeletedReferencedMessage):
+        return None, []
+    if reply is not None:
+        metrics.reference_lookups.inc(source="resolved")
+    else:
+        metrics.reference_lookups.inc(source="fetch")
+        try:
+            reply = await message.channel.fetch_message(reference.message_id)
+        except disnake.NotFound:
+            return None, []
+    if reply.author.id == bot.user.id:
+        return reply.id, []
+    # Replying to someone's file brings it into the prompt again (served from the cache)
+    return None, [att for att in reply.attachments if is_text_attachment(att)]
 
 @bot.event
 async def on_ready():
@@ -101,8 +424,6 @@ async def on_ready():
 
 @bot.event
 async def on_message(message):
-    global model_info
-    
     # Ignore own messages and bots
     if message.author.bot or message.author.id == bot.user.id:
         return
@@ -117,38 +438,13 @@ async def on_message(message):
 
     channel_id = message.channel.id
     
-    # Context handling for replies
-    context = None
-    if message.reference:
-        try:
-            reply = await message.channel.fetch_message(message.reference.message_id)
-            if reply.author.id == bot.user.id:
-                if channel_id in messages and reply.id in messages[channel_id]:
-                    context = messages[channel_id][reply.id]
-        except disnake.NotFound:
-            pass
+    # Context handling for replies, the context itself is looked up when the generation runs
+    reply_to = None
+    text_attachments = [att for att in message.attachments if is_text_attachment(att)]
+    if message.reference and message.reference.message_id:
+        reply_to, replied_attachments = await resolve_reference(message)
+        text_attachments += replied_attachments
             
-    # Fetch model info if needed
-    if model_info is None:
-        try:
-            info = await make_request("/api/show", "post", {"name": MODEL})
-            if isinstance(info, str):
-                model_info = json.loads(info)
-            else:
-                model_info = info
-        except Exception as e:
-            logger.error("Failed to fetch model info")
-            log_error(e)
-            
-    # Prepare system message
-    system_messages = []
-    if USE_MODEL_SYSTEM and model_info and model_info.get("system"):
-        system_messages.append(model_info["system"])
-    if use_custom_system_message:
-        system_messages.append(custom_system_message)
-        
-    system_message = "\n\n".join(system_messages)
-
     # Clean user input (remove mention)
     user_input = message.content.replace(bot.user.mention, "").strip()
     # Also handle nickname mentions if needed, but disnake handles mentions well usually.
@@ -163,39 +459,93 @@ async def on_message(message):
     if user_input.startswith("."):
         args = user_input[1:].split()
         cmd = args[0].lower()
+        metrics.commands.inc(command=cmd if cmd in TEXT_COMMANDS else "unknown")
         
         if cmd in ["reset", "clear"]:
-            if channel_id in messages:
-                cleared = messages[channel_id]["amount"]
-                del messages[channel_id]
-                if cleared > 0:
-                    await message.reply(f"Cleared conversation of {cleared} messages")
-                    return
-            await message.reply("No messages to clear")
+            # A generation still running would answer in the conversation being ended
+            await cancel_jobs(channel_id, "reset")
+            cleared = contexts.clear(channel_id)
+            if cleared > 0:
+                await send_reply(message, f"Cleared conversation of {cleared} messages")
+                return
+            await send_reply(message, "No messages to clear")
+            return
+            
+        elif cmd == "stop":
+            # Anyone can stop the channel's answers, only their own images
+            messages = len(await cancel_jobs(channel_id, "stop"))
+            text2img = bot.get_cog("Text2Img")
+            images = text2img.queue.cancel(channel_id, message.author.id) if text2img else 0
+            if images:
+                metrics.cancellations.inc(images, command="text2img", reason="stop")
+            if not messages and not images:
+                await send_reply(message, "Nothing to stop")
+                return
+            stopped = []
+            if messages:
+                stopped.append(f"answering {messages} {'message' if messages == 1 else 'messages'}")
+            if images:
+                stopped.append(f"{images} image {'request' if images == 1 else 'requests'}")
+            await send_reply(message, f"Stopped {' and '.join(stopped)}")
             return
             
         elif cmd in ["help", "?", "h"]:
-            await message.reply("Commands:\n- `.reset` `.clear`\n- `.help` `.?` `.h`\n- `.ping`\n- `.model`\n- `.system`")
+            await send_reply(message, "Commands:\n- `.reset` `.clear`\n- `.stop`\n- `.help` `.?` `.h`\n- `.ping`\n- `.model` `.model <name>` `.model reset`\n- `.system`\n- `.cache` `.cache on` `.cache off`\n- `.forget`")
+            return
+            
+        elif cmd == "cache":
+            if response_cache is None:
+                await send_reply(message, "Response cache is disabled")
+                return
+            if len(args) > 1 and args[1].lower() in ("on", "off"):
+                if args[1].lower() == "off":
+                    uncached_channels.add(channel_id)
+                else:
+                    uncached_channels.discard(channel_id)
+            status = "off" if channel_id in uncached_channels else "on"
+            await send_reply(message, f"Response cache is {status} in this channel: {response_cache.stats()}")
             return
             
         elif cmd == "model":
-            await message.reply(f"Current model: {MODEL}")
+            if len(args) > 1:
+                model = args[1]
+                if model.lower() in ("reset", "default"):
+                    channel_models.pop(channel_id, None)
+                elif await get_model_info(model) is None:
+                    await send_reply(message, f"Unknown model `{model}`")
+                    return
+                else:
+                    channel_models[channel_id] = model
+                if CONTEXT_MODE != "chat":
+                    # Token contexts only mean something to the model that produced them
+                    contexts.clear(channel_id)
+            await send_reply(message, f"Current model: {model_for(channel_id)}")
+            return
+            
+        elif cmd == "forget":
+            # .reset only ends the conversation, this also wipes what the bot remembers of the channel
+            if memory is None:
+                await send_reply(message, "Channel memory is disabled")
+                return
+            amount = await memory.forget(channel_id)
+            await send_reply(message, f"Forgot {amount} {'exchange' if amount == 1 else 'exchanges'}")
             return
             
         elif cmd == "system":
+            system_message = await get_system_message(model_for(channel_id))
             await reply_split_message(message, f"System message:\n\n{system_message}")
             return
             
         elif cmd == "ping":
             before = datetime.datetime.now()
-            msg = await message.reply("Ping")
+            msg = await send_reply(message, "Ping")
             after = datetime.datetime.now()
             diff = (after - before).total_seconds() * 1000
-            await msg.edit(content=f"Ping: {diff:.0f}ms")
+            await send_queue.run(channel_id, "edit", lambda: msg.edit(content=f"Ping: {diff:.0f}ms"))
             return
             
         else:
-            await message.reply("Unknown command, type `.help` for a list of commands")
+            await send_reply(message, "Unknown command, type `.help` for a list of commands")
             return
 
     # Check mention requirement
@@ -218,101 +568,211 @@ async def on_message(message):
     if not user_input and not message.attachments:
         return
 
+    # Turn requests away early, before anything is downloaded or queued
+    if len(channel_queue) + len(fair_queue) >= MAX_PENDING:
+        metrics.rejections.inc(command="chat", reason="busy")
+        await send_reply(message, "I'm busy right now, please try again in a moment")
+        return
+    wait = chat_quotas.admit(message.author.id, message.guild.id if message.guild else None)
+    if wait:
+        metrics.rejections.inc(command="chat", reason="quota")
+        await send_reply(message, f"You're sending messages too quickly, try again in {math.ceil(wait)}s")
+        return
+
     # Handle text attachments
-    if message.attachments:
-        text_attachments = [att for att in message.attachments if att.content_type and att.content_type.startswith("text")]
-        if text_attachments:
-            try:
-                for i, att in enumerate(text_attachments):
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(att.url) as resp:
-                            content = await resp.text()
-                            user_input += f"\n{i + 1}. File - {att.filename}:\n{content}"
-            except Exception as e:
-                logger.error(f"Failed to download text files: {e}")
-                await message.reply("Failed to download text files")
-                return
+    notes = []
+    if text_attachments:
+        try:
+            files, notes = await attachment_reader.ingest(text_attachments, int(ATTACHMENT_TOKENS * CHARS_PER_TOKEN))
+            user_input += files
+        except Exception as e:
+            logger.error(f"Failed to download text files: {e}")
+            metrics.command_errors.inc(command="chat")
+            await send_reply(message, "Failed to download text files")
+            return
 
-    # Create conversation if needed
-    if channel_id not in messages:
-        messages[channel_id] = {"amount": 0, "last": None}
-        
     logger.debug(f"{message.guild.name if message.guild else 'DMs'} - {message.author.name}: {user_input}")
     
+    metrics.commands.inc(command="chat")
+    job = {"message": message, "input": user_input, "reply_to": reply_to, "notes": notes}
+    if SUPERSEDE:
+        # The author added to the question being answered, start over and answer both together
+        running = channel_queue.running(channel_id)
+        if running and all(j["message"].author.id == message.author.id and j["reply_to"] == reply_to for j in running):
+            restarted = channel_queue.cancel(channel_id, {j["message"].id for j in running}, requeue=True)
+            if restarted:
+                metrics.cancellations.inc(len(restarted), command="chat", reason="superseded")
+    position = channel_queue.put(channel_id, job)
+    if position > 0:
+        notice = await send_reply(message, f"Queued, position {position}")
+        if job.get("started") or job.get("cancelled"):
+            await send_queue.run(channel_id, "delete", notice.delete)
+        else:
+            job["notice"] = notice
+
+@bot.event
+async def on_raw_message_delete(payload):
+    # A deleted message needs no answer anymore
+    await cancel_jobs(payload.channel_id, "deleted", {payload.message_id})
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    await cancel_jobs(payload.channel_id, "deleted", payload.message_ids)
+
+async def generate(channel_id, jobs):
+    # Replies go to the newest message of the burst
+    message = jobs[-1]["message"]
+    now = time.monotonic()
+    for job in jobs:
+        job["started"] = True
+        metrics.queue_wait.observe(now - job["queued"], queue="chat")
+        if job.get("notice"):
+            try:
+                await send_queue.run(channel_id, "delete", job["notice"].delete)
+            except disnake.HTTPException:
+                pass
+    if len(jobs) > 1:
+        logger.debug(f"Coalesced {len(jobs)} messages in {channel_id}")
+        
+    user_input = merge_inputs(jobs)
+    question = user_input
+    model = model_for(channel_id)
+    system_message = await get_system_message(model)
+    
     # Typing
     async with message.channel.typing():
         try:
+            # Replying to an earlier answer branches the conversation from that turn
+            parent = None
+            if jobs[0]["reply_to"]:
+                parent = contexts.turn_of(channel_id, jobs[0]["reply_to"])
+            if parent is None:
+                parent = contexts.turn_of(channel_id)
+            context = contexts.get(channel_id, parent) if parent is not None else None
             if context is None:
-                context = messages[channel_id]["last"]
+                parent = None
+            else:
+                logger.debug(f"Continuing turn {parent} at depth {contexts.depth(channel_id, parent)} in {channel_id}")
                 
-            if use_initial_prompt and messages[channel_id]["amount"] == 0:
+            amount = contexts.amount(channel_id)
+            if use_initial_prompt and amount == 0:
                 user_input = f"{initial_prompt_parsed}\n\n{user_input}"
                 logger.debug("Adding initial prompt to message")
                 
-            # Make request
-            payload = {
-                "model": MODEL,
-                "prompt": user_input,
-                "system": system_message,
-                "context": context,
-                "stream": False
-            }
-            
-            response_data = await make_request("/api/generate", "post", payload)
+            prefix = ""
+            if SHOW_START_OF_CONVERSATION and amount == 0:
+                prefix = "> This is the beginning of the conversation, type `.help` for help.\n\n"
+            notes = [note for job in jobs for note in job["notes"]]
+            if notes:
+                prefix += "".join(f"> {note}\n" for note in notes) + "\n"
+
+            # Context-free prompts can be answered from the response cache
+            cache_vector = None
+            cacheable = response_cache is not None and context is None and channel_id not in uncached_channels
+            if cacheable:
+                cached, cache_vector = await response_cache.lookup(model, system_message, user_input)
+                if cached:
+                    reply_msgs = await reply_split_message(message, prefix + cached["text"])
+                    if cached["context"]:
+                        contexts.save_turn(channel_id, [m.id for m in reply_msgs], cached["context"])
+                    return
+                    
+            # Keep the prompt within the model's window, leaving room for the answer
+            window = context_window(model, CONTEXT_BUDGETS, model_infos.get(model))
+            budget = max(window - CONTEXT_RESERVE, 0)
+            dropped = []
+            memories = []
             
-            response_objs = []
-            if isinstance(response_data, str):
-                # It's a stream of JSONs (fallback if stream=False is ignored or fails)
-                lines = response_data.strip().split("\n")
-                for line in lines:
-                    if line.strip():
-                        try:
-                            response_objs.append(json.loads(line))
-                        except Exception as e:
-                            logger.warning(f"Failed to parse JSON line: {line} - Error: {e}")
-            elif isinstance(response_data, dict):
-                response_objs.append(response_data)
+            # Make request
+            if CONTEXT_MODE == "chat":
+                user_message = {"role": "user", "content": user_input}
+                system = [{"role": "system", "content": system_message}] if system_message else []
+                fixed = sum(message_tokens(m, CHARS_PER_TOKEN) for m in system + [user_message])
+                history, dropped = fit_history(context or [], budget - fixed, CHARS_PER_TOKEN)
+                if memory is not None:
+                    kept = sum(1 for m in history if m["role"] == "assistant")
+                    memories = await memory.recall(channel_id, question, recent_turns(channel_id, parent, kept))
+                if memories:
+                    # Fit again with the recalled exchanges counted in
+                    system.append({"role": "system", "content": memory_prompt(memories)})
+                    fixed = sum(message_tokens(m, CHARS_PER_TOKEN) for m in system + [user_message])
+                    history, dropped = fit_history(context or [], budget - fixed, CHARS_PER_TOKEN)
+                path = "/api/chat"
+                payload = {
+                    "model": model,
+                    "messages": system + history + [user_message],
+                    "stream": STREAM
+                }
             else:
-                logger.warning(f"Unexpected response type: {type(response_data)}")
-                
-            response_text = "".join([r.get("response", "") for r in response_objs])
-            if not response_text:
-                logger.warning(f"Empty response text. Raw data: {response_data}")
-                response_text = "(No response)"
-                
-            logger.debug(f"Response: {response_text}")
+                # The system prompt and the new prompt share the window with the context
+                fixed = estimate_tokens(system_message + user_input, CHARS_PER_TOKEN)
+                truncated = truncate_context(context, budget - fixed)
+                if memory is not None:
+                    # Tokens don't map back to turns, assume the kept share of the context holds the same share of them
+                    turns = contexts.depth(channel_id, parent) + 1 if parent is not None else 0
+                    kept = math.ceil(turns * len(truncated) / len(context)) if context else 0
+                    memories = await memory.recall(channel_id, question, recent_turns(channel_id, parent, kept))
+                system = system_message
+                if memories:
+                    system = "\n\n".join(filter(None, [system_message, memory_prompt(memories)]))
+                    # Truncate again with the recalled exchanges counted in
+                    fixed = estimate_tokens(system + user_input, CHARS_PER_TOKEN)
+                    truncated = truncate_context(context, budget - fixed)
+                path = "/api/generate"
+                payload = {
+                    "model": model,
+                    "prompt": user_input,
+                    "system": system,
+                    "context": truncated,
+                    "stream": STREAM
+                }
+            if CONTEXT_BUDGETS:
+                # Make Ollama use the configured window instead of its default
+                payload["options"] = {"num_ctx": window}
             
-            prefix = ""
-            if SHOW_START_OF_CONVERSATION and messages[channel_id]["amount"] == 0:
-                prefix = "> This is the beginning of the conversation, type `.help` for help.\n\n"
-                
-            reply_msgs = await reply_split_message(message, prefix + response_text)
+            # Guilds (or DM users) take turns for the backends by weight
+            async with fair_queue.slot(message.guild.id if message.guild else message.author.id):
+                if STREAM:
+                    response_objs, reply_msgs, response_text = await stream_reply(message, prefix, path, payload)
+                else:
+                    response_objs, reply_msgs, response_text = await complete_reply(message, prefix, path, payload)
             reply_ids = [m.id for m in reply_msgs]
+            for r in response_objs:
+                if r.get("done"):
+                    metrics.record_generation(model, r)
             
+
             # Update context
-            # Find the object with done=True and context
             final_context = None
-            for r in response_objs:
-                if r.get("done") and r.get("context"):
-                    final_context = r.get("context")
-                    break
+            if CONTEXT_MODE == "chat":
+                final_context = history + [user_message, {"role": "assistant", "content": response_text}]
+            else:
+                # Find the object with done=True and context
+                for r in response_objs:
+                    if r.get("done") and r.get("context"):
+                        final_context = r.get("context")
+                        break
             
             if final_context:
-                for rid in reply_ids:
-                    if channel_id not in messages: messages[channel_id] = {"amount": 0, "last": None} # Safety
-                    # We store context mapped to the reply ID so we can continue from it
-                    if channel_id not in messages: messages[channel_id] = {} # Should be there
-                    # Wait, messages[channel_id] is a dict with keys 'amount', 'last', and message IDs?
-                    # Original: messages[channelID][replyMessageIDs[i]] = context;
-                    messages[channel_id][rid] = final_context
-                
-                messages[channel_id]["last"] = final_context
-                messages[channel_id]["amount"] += 1
+                # Stored once and mapped to every reply ID so we can continue from any of them
+                contexts.save_turn(channel_id, reply_ids, final_context, parent)
+                if dropped and CONTEXT_SUMMARIZE and reply_ids:
+                    task = asyncio.create_task(summarize(channel_id, reply_ids[0], final_context, dropped))
+                    background_tasks.add(task)
+                    task.add_done_callback(background_tasks.discard)
+            if memory is not None and response_text and reply_ids:
+                task = asyncio.create_task(memory.remember(channel_id, reply_ids[0], memory_text(jobs, question, response_text)))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+            # Answers that drew on the channel's memory are specific to it
+            if cacheable and response_text and not memories:
+                response_cache.store(model, system_message, user_input, response_text, final_context, cache_vector)
                 
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             log_error(e)
-            await message.reply("Error, please check the console")
+            metrics.command_errors.inc(command="chat")
+            await send_reply(message, "Error, please check the console")
 
 if __name__ == "__main__":
     bot.run(TOKEN)
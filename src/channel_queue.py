@@ -0,0 +1,116 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("Bot")
+
+class ChannelQueue:
+    # Runs generations one at a time per channel, merging bursts of messages into a single job
+    def __init__(self, handler, debounce=1.0, max_batch=4):
+        self.handler = handler  # async def handler(channel_id, jobs)
+        self.debounce = debounce
+        self.max_batch = max_batch
+        self.channels = {}  # channel_id -> {"pending": [job], "running": {"jobs", "task"} or None, "worker": Task}
+
+    def __len__(self):
+        # Jobs waiting across all channels, not counting running generations
+        return sum(len(channel["pending"]) for channel in self.channels.values())
+
+    def put(self, channel_id, job):
+        # job: {"message", "input", "reply_to", ...}; returns its queue position
+        job["queued"] = time.monotonic()
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = {"pending": [], "running": None, "worker": None}
+            self.channels[channel_id] = channel
+        channel["pending"].append(job)
+        if channel["worker"] is None:
+            channel["worker"] = asyncio.create_task(self._work(channel_id, channel))
+        # Number of generations that will run before this one
+        groups = self._groups(channel["pending"])
+        return len(groups) - 1 + (1 if channel["running"] else 0)
+
+    def running(self, channel_id):
+        # Jobs of the channel's generation in progress
+        channel = self.channels.get(channel_id)
+        return channel["running"]["jobs"] if channel and channel["running"] else []
+
+    def cancel(self, channel_id, message_ids=None, requeue=False):
+        # Drops the channel's queued jobs and aborts its running generation, or with message_ids only the
+        # jobs of those messages; a generation shared with other messages keeps running for them.
+        # requeue puts an aborted generation's jobs back in front instead. Returns the jobs taken out or put back
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return []
+        matches = lambda job: message_ids is None or job["message"].id in message_ids
+        dropped = []
+        if not requeue:
+            dropped = [job for job in channel["pending"] if matches(job)]
+            channel["pending"] = [job for job in channel["pending"] if not matches(job)]
+            for job in dropped:
+                job["cancelled"] = True
+        running = channel["running"]
+        if running and not running["task"].done() and not running["task"].cancelling():
+            if requeue:
+                if all(matches(job) for job in running["jobs"]):
+                    running["task"].cancel()
+                    channel["pending"][:0] = running["jobs"]
+                    dropped = list(running["jobs"])
+            else:
+                for job in running["jobs"]:
+                    if matches(job):
+                        job["cancelled"] = True
+                if all(job.get("cancelled") for job in running["jobs"]):
+                    running["task"].cancel()
+                    dropped += running["jobs"]
+        return dropped
+
+    def _compatible(self, a, b):
+        # Only messages continuing the same conversation branch can share a prompt
+        return a["reply_to"] == b["reply_to"]
+
+    def _groups(self, pending):
+        groups = []
+        for job in pending:
+            if groups and len(groups[-1]) < self.max_batch and self._compatible(groups[-1][0], job):
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        return groups
+
+    async def _work(self, channel_id, channel):
+        try:
+            while channel["pending"]:
+                # Wait until the channel has been quiet for the debounce window
+                while channel["pending"] and len(channel["pending"]) < self.max_batch:
+                    remaining = channel["pending"][-1]["queued"] + self.debounce - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(remaining)
+                if not channel["pending"]:
+                    # Everything waiting was cancelled meanwhile
+                    break
+
+                batch = self._groups(channel["pending"])[0]
+                del channel["pending"][:len(batch)]
+                # Its own task, so the generation can be aborted without stopping the channel's worker
+                task = asyncio.create_task(self.handler(channel_id, batch))
+                channel["running"] = {"jobs": batch, "task": task}
+                try:
+                    await asyncio.wait([task])
+                finally:
+                    task.cancel()
+                    channel["running"] = None
+                if task.cancelled():
+                    logger.debug(f"Cancelled a generation of {len(batch)} messages in {channel_id}")
+                elif task.exception():
+                    logger.error(f"Error processing queued messages in {channel_id}: {task.exception()}")
+        finally:
+            del self.channels[channel_id]
+
+def merge_inputs(jobs):
+    # Prefix each part with its author when several people wrote in the burst
+    authors = {job["message"].author.id for job in jobs}
+    if len(authors) == 1:
+        return "\n\n".join(job["input"] for job in jobs)
+    return "\n\n".join(f"{job['message'].author.name}: {job['input']}" for job in jobs)
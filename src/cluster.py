@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import tempfile
+import aiohttp
+from .scheduler import PoolServer
+from .utils import (
+    ollama_pool,
+    stable_diffusion_pool,
+    open_sessions,
+    close_sessions,
+    preload_models,
+    start_health_checks,
+    stop_health_checks,
+    logger
+)
+
+def parse_shard_ids(spec):
+    # "0-3,8" -> [0, 1, 2, 3, 8], None when unset
+    ids = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-", 1)
+            ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            ids.append(int(part))
+    return ids or None
+
+def shard_ranges(shard_count, workers):
+    # Contiguous ranges of (nearly) equal size, one per worker
+    workers = max(min(workers, shard_count), 1)
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end - 1))
+        start = end
+    return ranges
+
+async def recommended_shards(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+async def run_worker(index, shards, env, script):
+    # Keeps one worker process alive, backing off when it keeps crashing
+    delay = 1
+    while True:
+        logger.info(f"Starting worker {index} for shards {shards[0]}-{shards[1]}")
+        process = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+        started = time.monotonic()
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise
+        delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 60)
+        logger.warning(f"Worker {index} exited with code {code}, restarting in {delay}s")
+        await asyncio.sleep(delay)
+
+async def run_cluster(workers, script):
+    # Spreads the bot's shards over worker processes that run `script` with SHARD_IDS set. The backend
+    # pools stay here and are shared over a local socket; conversations are shared through SQLite
+    token = os.getenv("TOKEN")
+    shard_count = int(os.getenv("SHARD_COUNT", "0")) or await recommended_shards(token)
+    ranges = shard_ranges(shard_count, workers)
+
+    pool_server = PoolServer({pool.name: pool for pool in (ollama_pool, stable_diffusion_pool)})
+    directory = tempfile.mkdtemp(prefix="discord-ai-bot-")
+    address = await pool_server.start("tcp://127.0.0.1:0" if sys.platform == "win32" else os.path.join(directory, "scheduler.sock"))
+    await open_sessions()
+    start_health_checks()
+    tasks = []
+    preload = [m.strip() for m in os.getenv("OLLAMA_PRELOAD", "").split(",") if m.strip()]
+    if preload:
+        # Workers skip this, the servers are shared
+        tasks.append(asyncio.create_task(preload_models(preload)))
+
+    if not os.getenv("CONTEXT_DB"):
+        logger.info("CONTEXT_DB is not set, sharing conversations through contexts.db")
+    metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    for i, shards in enumerate(ranges):
+        env = dict(os.environ)
+        env.update({
+            "SHARD_IDS": f"{shards[0]}-{shards[1]}",
+            "SHARD_COUNT": str(shard_count),
+            "SCHEDULER_ADDRESS": address,
+            "CONTEXT_DB": os.getenv("CONTEXT_DB") or "contexts.db"
+        })
+        if metrics_port:
+            # Every worker serves its own metrics
+            env["METRICS_PORT"] = str(metrics_port + i)
+        tasks.append(asyncio.create_task(run_worker(i, shards, env, script)))
+    logger.info(f"Running {shard_count} shards in {len(ranges)} workers")
+
+    stop = asyncio.Event()
+    if sys.platform != "win32":
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stop_health_checks()
+        pool_server.close()
+        await close_sessions()
+        if os.path.exists(os.path.join(directory, "scheduler.sock")):
+            os.remove(os.path.join(directory, "scheduler.sock"))
+        os.rmdir(directory)
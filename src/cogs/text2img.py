@@ -1,12 +1,79 @@
+import os
 import disnake
 from disnake.ext import commands
-import base64
 import io
-from ..utils import make_stable_diffusion_request, log_error
+import math
+import time
+from .. import metrics
+from ..sd_queue import Text2ImgQueue, JobCancelled
+from ..admission import Quotas, parse_quotas
+from ..image_cache import ImageCache, cache_key, derive_seed
+from ..offload import b64decode_all, run_in_thread
+from ..utils import (
+    make_stable_diffusion_request,
+    get_stable_diffusion_progress,
+    get_stable_diffusion_options,
+    interrupt_stable_diffusion,
+    stable_diffusion_pool,
+    get_boolean,
+    log_error,
+    logger
+)
+
+IMAGE_CACHE = get_boolean(os.getenv("IMAGE_CACHE"))
 
 class Text2Img(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # One worker per backend slot so every Stable Diffusion server stays busy
+        self.queue = Text2ImgQueue(
+            lambda payload, on_server: make_stable_diffusion_request("/sdapi/v1/txt2img", "post", payload, on_server),
+            get_stable_diffusion_progress,
+            workers=max(sum(server.slots for server in stable_diffusion_pool.servers), 1),
+            max_batch=int(os.getenv("TEXT2IMG_MAX_BATCH", "8")),
+            progress_interval=float(os.getenv("TEXT2IMG_PROGRESS_INTERVAL", "2.0")),
+            interrupt=interrupt_stable_diffusion
+        )
+
+        # Deterministic mode: pinned seeds and an on-disk cache of what they rendered
+        self.image_cache = None
+        if IMAGE_CACHE:
+            self.image_cache = ImageCache(
+                os.getenv("IMAGE_CACHE_DIR", "image_cache"),
+                max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))),
+                image_format=os.getenv("IMAGE_CACHE_FORMAT", "png"),
+                quality=int(os.getenv("IMAGE_CACHE_QUALITY", "90"))
+            )
+        self.fixed_model = os.getenv("STABLE_DIFFUSION_MODEL")
+        self.model = None
+        self.model_checked = -math.inf
+        self.model_ttl = float(os.getenv("STABLE_DIFFUSION_MODEL_TTL", "60"))
+        
+        self.quotas = Quotas(parse_quotas(os.getenv("TEXT2IMG_QUOTAS")))
+        self.max_pending = int(os.getenv("TEXT2IMG_MAX_PENDING", "50"))
+
+    async def get_model(self):
+        # The checkpoint is part of the cache key, a different model renders different images. Asked again
+        # after the TTL, as it can be switched on the server; None while it can't be told
+        if self.fixed_model:
+            return self.fixed_model
+        if time.monotonic() - self.model_checked < self.model_ttl:
+            return self.model
+        self.model_checked = time.monotonic()
+        self.model = None
+        server = next((server for server in stable_diffusion_pool.servers if server.healthy), None)
+        if server is None:
+            return None
+        try:
+            options = await get_stable_diffusion_options(server)
+            self.model = options.get("sd_model_checkpoint") or None
+        except Exception as e:
+            logger.error("Failed to fetch the Stable Diffusion model")
+            log_error(e)
+        return self.model
+
+    def cog_unload(self):
+        self.queue.stop()
 
     @commands.slash_command(name="text2img", description="Convert text to image")
     async def text2img(
@@ -18,9 +85,21 @@ class Text2Img(commands.Cog):
         steps: int = commands.Param(default=10, min_value=5, max_value=20),
         batch_count: int = commands.Param(default=1, min_value=1, max_value=4),
         batch_size: int = commands.Param(default=1, min_value=1, max_value=5),
-        enhance_prompt: bool = False
+        enhance_prompt: bool = False,
+        seed: int = commands.Param(default=-1, min_value=-1, max_value=2147483647)
     ):
         await inter.response.defer()
+        metrics.commands.inc(command="text2img")
+        
+        if len(self.queue) >= self.max_pending:
+            metrics.rejections.inc(command="text2img", reason="busy")
+            await inter.edit_original_response(content="Too many images are being generated right now, please try again in a moment")
+            return
+        wait = self.quotas.admit(inter.author.id, inter.guild_id)
+        if wait:
+            metrics.rejections.inc(command="text2img", reason="quota")
+            await inter.edit_original_response(content=f"You're generating images too quickly, try again in {math.ceil(wait)}s")
+            return
         
         try:
             payload = {
@@ -34,21 +113,48 @@ class Text2Img(commands.Cog):
                 "enhance_prompt": "yes" if enhance_prompt else "no"
             }
             
-            response = await make_stable_diffusion_request("/sdapi/v1/txt2img", "post", payload)
+            key = None
+            if self.image_cache:
+                if seed < 0:
+                    seed = derive_seed(prompt)
+                payload["seed"] = seed
+                model = await self.get_model()
+                # Without the model, a cached render may not be what the server would draw now
+                if model:
+                    key = cache_key(payload=payload, model=model)
+                    cached = await run_in_thread(self.image_cache.get, key)
+                    if cached:
+                        await self.send_images(inter, prompt, cached)
+                        return
+            elif seed >= 0:
+                payload["seed"] = seed
             
-            images = []
-            for img_str in response.get("images", []):
-                img_bytes = base64.b64decode(img_str)
-                images.append(disnake.File(io.BytesIO(img_bytes), filename="image.png"))
-                
-            await inter.edit_original_response(
-                content=f"Here are images from prompt `{prompt}`",
-                files=images
-            )
+            async def on_progress(text):
+                await inter.edit_original_response(content=f"{text}\nPrompt: `{prompt}`")
             
+            # Compatible requests from other users may share the same backend call
+            images_b64 = await self.queue.submit(inter.author.id, payload, on_progress, inter.channel_id)
+            
+            images = [(data, "png") for data in await b64decode_all(images_b64)]
+            if key:
+                # Re-encoding and writing release the GIL
+                images = await run_in_thread(self.image_cache.put, key, [data for data, _ in images])
+            await self.send_images(inter, prompt, images)
+            
+        except JobCancelled:
+            # .stop in the channel
+            await inter.edit_original_response(content=f"Stopped generating images from prompt `{prompt}`")
         except Exception as e:
             log_error(e)
+            metrics.command_errors.inc(command="text2img")
             await inter.edit_original_response(content="Error, please check the console")
 
+    async def send_images(self, inter, prompt, images):
+        files = [disnake.File(io.BytesIO(data), filename=f"image.{ext}") for data, ext in images]
+        await metrics.timed(metrics.discord_latency, inter.edit_original_response(
+            content=f"Here are images from prompt `{prompt}`",
+            files=files
+        ), operation="edit")
+
 def setup(bot):
     bot.add_cog(Text2Img(bot))
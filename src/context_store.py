@@ -0,0 +1,384 @@
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict, deque
+from .offload import thread_pool
+
+logger = logging.getLogger("Bot")
+
+# Rough per-entry bookkeeping overhead on top of the packed data
+ENTRY_OVERHEAD = 200
+CHUNK_OVERHEAD = 100
+# Contexts are cut into chunks of this many tokens (or chat messages), the unit shared between branches
+CHUNK_TOKENS = 256
+CHUNK_MESSAGES = 4
+KEY_SIZE = 16
+
+def chunk_key(data):
+    return hashlib.blake2b(data, digest_size=KEY_SIZE).digest()
+
+def pack(context):
+    # Token contexts become int32 arrays, chat histories compact JSON, both as a kind and a list of chunks
+    if all(isinstance(token, int) for token in context):
+        return b"a", [array("i", context[i:i + CHUNK_TOKENS]).tobytes() for i in range(0, len(context), CHUNK_TOKENS)]
+    return b"j", [json.dumps(context[i:i + CHUNK_MESSAGES], separators=(",", ":")).encode() for i in range(0, len(context), CHUNK_MESSAGES)]
+
+def unpack(kind, chunks):
+    if kind == b"a":
+        tokens = array("i")
+        for data in chunks:
+            tokens.frombytes(data)
+        return tokens.tolist()
+    return [message for data in chunks for message in json.loads(data)]
+
+class ContextStore:
+    # Conversation trees per channel: every answer is a turn whose parent is the turn it continued, so
+    # replying to an earlier answer starts a branch. Contexts are stored as content-addressed chunks, which
+    # lets the turns of a conversation share their common prefix instead of each holding a full copy.
+    # Turns are kept in an LRU bounded by a memory budget and a TTL, optionally backed by SQLite so cold
+    # conversations survive eviction and restarts
+    def __init__(self, memory_budget=64 * 1024 * 1024, ttl=3600.0, path=None, disk_max_age=0.0, busy_timeout=0.5):
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.disk_max_age = disk_max_age
+        self.turns = OrderedDict()  # (channel_id, turn_id) -> {"kind", "chunks": [key], "parent", "depth", "access"}
+        self.chunks = {}  # key -> [data, number of references from turns]
+        self.channels = OrderedDict()  # channel_id -> {"amount": int, "last": turn_id, "refs": {message_id: turn_id}, "access": float}
+        self.size = 0
+        self.db = None  # Reads, on the event loop
+        self.write_db = None  # Writes, queued and run in order in the offload threads
+        self.writes = deque()
+        self.writing = None  # Future of the thread draining the writes
+        # Writes still queued, per channel: {"writes": int, "clears": int, "turns": {turn_id: int}}. Until they are
+        # done the disk is behind memory, so unwritten turns stay in memory and a cleared channel isn't read back
+        self.pending = {}
+        self.lock = threading.Lock()
+        if path:
+            # Cluster workers share one database, WAL lets them read while another one writes. Only the
+            # writer may wait on another worker's lock, reads never hold up the event loop for long
+            self.write_db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.write_db.execute("PRAGMA journal_mode=WAL")
+            self.write_db.executescript("""
+                CREATE TABLE IF NOT EXISTS channels (channel_id INTEGER PRIMARY KEY, amount INTEGER, last INTEGER, updated REAL);
+                CREATE TABLE IF NOT EXISTS nodes (channel_id INTEGER, turn_id INTEGER, parent INTEGER, depth INTEGER, kind BLOB, chunks BLOB, updated REAL, PRIMARY KEY (channel_id, turn_id));
+                CREATE TABLE IF NOT EXISTS chunks (key BLOB PRIMARY KEY, data BLOB, refs INTEGER);
+                CREATE TABLE IF NOT EXISTS refs (channel_id INTEGER, message_id INTEGER, turn_id INTEGER, PRIMARY KEY (channel_id, message_id));
+            """)
+            self.purge_disk()
+            self.db = sqlite3.connect(path, timeout=busy_timeout)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def _on_disk(self, channel_id):
+        # Whether the disk may be read for a channel, not while a clear of it is still queued
+        if not self.db:
+            return False
+        with self.lock:
+            pending = self.pending.get(channel_id)
+            return not (pending and pending["clears"])
+
+    def _unwritten(self, channel_id, turn_id=None):
+        with self.lock:
+            pending = self.pending.get(channel_id)
+            return bool(pending) if turn_id is None else bool(pending and pending["turns"].get(turn_id))
+
+    def _channel(self, channel_id, create=False):
+        channel = self.channels.get(channel_id)
+        if channel is None and self._on_disk(channel_id):
+            row = self.db.execute("SELECT amount, last FROM channels WHERE channel_id = ?", (channel_id,)).fetchone()
+            if row:
+                channel = {"amount": row[0], "last": row[1], "refs": {}}
+                self.channels[channel_id] = channel
+        if channel is None and create:
+            channel = {"amount": 0, "last": None, "refs": {}}
+            self.channels[channel_id] = channel
+        if channel is not None:
+            channel["access"] = time.monotonic()
+            self.channels.move_to_end(channel_id)
+        return channel
+
+    def _turn_id(self, channel, channel_id, message_id):
+        if message_id is None:
+            return channel["last"]
+        turn_id = channel["refs"].get(message_id)
+        if turn_id is None and self._on_disk(channel_id):
+            row = self.db.execute("SELECT turn_id FROM refs WHERE channel_id = ? AND message_id = ?", (channel_id, message_id)).fetchone()
+            if row:
+                turn_id = channel["refs"][message_id] = row[0]
+        return turn_id
+
+    def amount(self, channel_id):
+        channel = self._channel(channel_id)
+        return channel["amount"] if channel else 0
+
+    def turn_of(self, channel_id, message_id=None):
+        # The turn a bot message belongs to (or the channel's last turn), None for messages we didn't send
+        channel = self._channel(channel_id)
+        return self._turn_id(channel, channel_id, message_id) if channel else None
+
+    def depth(self, channel_id, turn_id):
+        # Number of earlier turns on the branch leading to this one
+        entry = self.turns.get((channel_id, turn_id))
+        if entry is not None:
+            return entry["depth"]
+        if self._on_disk(channel_id):
+            row = self.db.execute("SELECT depth FROM nodes WHERE channel_id = ? AND turn_id = ?", (channel_id, turn_id)).fetchone()
+            if row:
+                return row[0]
+        return 0
+
+    def parent(self, channel_id, turn_id):
+        # The turn this one continued, None at the start of a conversation
+        entry = self.turns.get((channel_id, turn_id))
+        if entry is not None:
+            return entry["parent"]
+        if self._on_disk(channel_id):
+            row = self.db.execute("SELECT parent FROM nodes WHERE channel_id = ? AND turn_id = ?", (channel_id, turn_id)).fetchone()
+            if row:
+                return row[0]
+        return None
+
+    def get(self, channel_id, message_id=None):
+        # Context of the turn a message belongs to, or of the channel's last turn
+        self.expire()
+        channel = self._channel(channel_id)
+        if channel is None:
+            return None
+        turn_id = self._turn_id(channel, channel_id, message_id)
+        if turn_id is None:
+            return None
+
+        key = (channel_id, turn_id)
+        entry = self.turns.get(key)
+        if entry is None and self._on_disk(channel_id):
+            # Lazily reload a conversation that was spilled out of memory
+            row = self.db.execute("SELECT parent, depth, kind, chunks FROM nodes WHERE channel_id = ? AND turn_id = ?", key).fetchone()
+            if row:
+                chunks = self._read_chunks(row[3])
+                if chunks is not None:
+                    entry = self._insert(key, row[2], chunks, row[0], row[1])
+        if entry is None:
+            return None
+        entry["access"] = time.monotonic()
+        self.turns.move_to_end(key)
+        return unpack(entry["kind"], [self.chunks[k][0] for k in entry["chunks"]])
+
+    def save_turn(self, channel_id, message_ids, context, parent=None):
+        # All reply messages of one answer share a single stored turn, continuing from the parent turn
+        if not message_ids:
+            return
+        channel = self._channel(channel_id, create=True)
+        turn_id = message_ids[0]
+        depth = self.depth(channel_id, parent) + 1 if parent is not None else 0
+        kind, datas = pack(context)
+        self._insert((channel_id, turn_id), kind, [(chunk_key(data), data) for data in datas], parent, depth)
+        for message_id in message_ids:
+            channel["refs"][message_id] = turn_id
+        channel["last"] = turn_id
+        channel["amount"] += 1
+
+        if self.db:
+            amount = channel["amount"]
+            def write(db):
+                now = time.time()
+                with db:
+                    self._delete_node(db, channel_id, turn_id)
+                    self._write_node(db, channel_id, turn_id, parent, depth, kind, datas, now)
+                    db.executemany("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)", [(channel_id, m, turn_id) for m in message_ids])
+                    db.execute("INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?)", (channel_id, amount, turn_id, now))
+            self._write(write, channel_id, turn_id)
+        self.expire()
+
+    def update_turn(self, channel_id, turn_id, context):
+        # Rewrites a stored turn in place (e.g. once a background summary is ready), keeping its place in the tree
+        key = (channel_id, turn_id)
+        kind, datas = pack(context)
+        entry = self.turns.get(key)
+        if entry is not None:
+            self._insert(key, kind, [(chunk_key(data), data) for data in datas], entry["parent"], entry["depth"])
+        if self.db:
+            def write(db):
+                with db:
+                    row = db.execute("SELECT parent, depth FROM nodes WHERE channel_id = ? AND turn_id = ?", key).fetchone()
+                    if row:
+                        self._delete_node(db, channel_id, turn_id)
+                        self._write_node(db, channel_id, turn_id, row[0], row[1], kind, datas, time.time())
+            self._write(write, channel_id, turn_id)
+
+    def clear(self, channel_id):
+        # Returns the amount of messages the conversation had
+        channel = self._channel(channel_id)
+        amount = channel["amount"] if channel else 0
+        self.channels.pop(channel_id, None)
+        for key in [key for key in self.turns if key[0] == channel_id]:
+            self._remove(key)
+        if self.db:
+            def write(db):
+                with db:
+                    self._delete_channels(db, [channel_id])
+            self._write(write, channel_id, clear=True)
+        return amount
+
+    def _write(self, write, channel_id, turn_id=None, clear=False):
+        # Disk writes leave the event loop, in order: write(db) runs on the writer connection
+        with self.lock:
+            pending = self.pending.setdefault(channel_id, {"writes": 0, "clears": 0, "turns": {}})
+            pending["writes"] += 1
+            pending["clears"] += clear
+            if turn_id is not None:
+                pending["turns"][turn_id] = pending["turns"].get(turn_id, 0) + 1
+            self.writes.append((write, channel_id, turn_id, clear))
+            if self.writing is None:
+                self.writing = thread_pool().submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.writes:
+                    self.writing = None
+                    return
+                write, channel_id, turn_id, clear = self.writes.popleft()
+            try:
+                write(self.write_db)
+            except Exception as e:
+                # The turn is still held in memory until evicted, only its copy on disk is missing
+                logger.error(f"Failed to write conversations to disk: {e}")
+            with self.lock:
+                pending = self.pending[channel_id]
+                pending["writes"] -= 1
+                pending["clears"] -= clear
+                if turn_id is not None:
+                    pending["turns"][turn_id] -= 1
+                    if not pending["turns"][turn_id]:
+                        del pending["turns"][turn_id]
+                if not pending["writes"]:
+                    del self.pending[channel_id]
+
+    def close(self):
+        # Finishes the queued writes, at shutdown
+        with self.lock:
+            writing = self.writing
+        if writing is not None:
+            writing.result()
+        self._drain()
+
+    def _insert(self, key, kind, chunks, parent, depth):
+        # chunks is a list of (key, data), data already held in memory is shared
+        if key in self.turns:
+            self._remove(key)
+        for chunk, data in chunks:
+            held = self.chunks.get(chunk)
+            if held is None:
+                held = self.chunks[chunk] = [data, 0]
+                self.size += len(data) + CHUNK_OVERHEAD
+            held[1] += 1
+        entry = {"kind": kind, "chunks": [chunk for chunk, _ in chunks], "parent": parent, "depth": depth, "access": time.monotonic()}
+        self.turns[key] = entry
+        self.size += ENTRY_OVERHEAD
+        return entry
+
+    def _remove(self, key):
+        entry = self.turns.pop(key)
+        self.size -= ENTRY_OVERHEAD
+        for chunk in entry["chunks"]:
+            held = self.chunks[chunk]
+            held[1] -= 1
+            if held[1] == 0:
+                del self.chunks[chunk]
+                self.size -= len(held[0]) + CHUNK_OVERHEAD
+
+    def _read_chunks(self, keys):
+        chunks = []
+        for i in range(0, len(keys), KEY_SIZE):
+            chunk = keys[i:i + KEY_SIZE]
+            held = self.chunks.get(chunk)
+            if held is None:
+                row = self.db.execute("SELECT data FROM chunks WHERE key = ?", (chunk,)).fetchone()
+                if row is None:
+                    logger.warning("Stored conversation turn is missing a chunk")
+                    return None
+                held = row
+            chunks.append((chunk, held[0]))
+        return chunks
+
+    def _write_node(self, db, channel_id, turn_id, parent, depth, kind, datas, updated):
+        # Chunks on disk are reference counted like in memory, callers hold the transaction
+        keys = [chunk_key(data) for data in datas]
+        db.executemany(
+            "INSERT INTO chunks VALUES (?, ?, 1) ON CONFLICT (key) DO UPDATE SET refs = refs + 1",
+            zip(keys, datas)
+        )
+        db.execute("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)", (channel_id, turn_id, parent, depth, kind, b"".join(keys), updated))
+
+    def _release_chunks(self, db, rows):
+        keys = [(row[0][i:i + KEY_SIZE],) for row in rows for i in range(0, len(row[0]), KEY_SIZE)]
+        db.executemany("UPDATE chunks SET refs = refs - 1 WHERE key = ?", keys)
+        db.execute("DELETE FROM chunks WHERE refs <= 0")
+
+    def _delete_node(self, db, channel_id, turn_id):
+        rows = db.execute("SELECT chunks FROM nodes WHERE channel_id = ? AND turn_id = ?", (channel_id, turn_id)).fetchall()
+        self._release_chunks(db, rows)
+        db.execute("DELETE FROM nodes WHERE channel_id = ? AND turn_id = ?", (channel_id, turn_id))
+
+    def _delete_channels(self, db, channel_ids):
+        for channel_id in channel_ids:
+            self._release_chunks(db, db.execute("SELECT chunks FROM nodes WHERE channel_id = ?", (channel_id,)).fetchall())
+            for table in ("channels", "nodes", "refs"):
+                db.execute(f"DELETE FROM {table} WHERE channel_id = ?", (channel_id,))
+
+    def _forget(self, key):
+        # References to an evicted turn go with it, a disk tier reloads them on demand. Without one the turn
+        # is gone, so the channel can't continue from it either
+        self._remove(key)
+        channel_id, turn_id = key
+        channel = self.channels.get(channel_id)
+        if channel:
+            channel["refs"] = {m: t for m, t in channel["refs"].items() if t != turn_id}
+            if channel["last"] == turn_id and not self.db:
+                channel["last"] = None
+
+    def expire(self):
+        now = time.monotonic()
+        # Entries are in LRU order, so the oldest ones are at the front. Those not written to disk yet are
+        # passed over (as if just used), the budget may be exceeded until their writes are done
+        skipped = 0
+        while len(self.turns) > skipped:
+            key, entry = next(iter(self.turns.items()))
+            if self.size <= self.memory_budget and now - entry["access"] < self.ttl:
+                break
+            if self._unwritten(*key):
+                entry["access"] = now
+                self.turns.move_to_end(key)
+                skipped += 1
+                continue
+            self._forget(key)
+        skipped = 0
+        while len(self.channels) > skipped:
+            channel_id, channel = next(iter(self.channels.items()))
+            if now - channel["access"] < self.ttl:
+                break
+            if self._unwritten(channel_id):
+                channel["access"] = now
+                self.channels.move_to_end(channel_id)
+                skipped += 1
+                continue
+            # Idle channel metadata is reloaded from disk on demand, or forgotten along with its turns
+            del self.channels[channel_id]
+            for key in [key for key in self.turns if key[0] == channel_id]:
+                self._remove(key)
+
+    def purge_disk(self):
+        # Runs at startup, before the event loop needs the store
+        if not self.write_db or self.disk_max_age <= 0:
+            return
+        cutoff = time.time() - self.disk_max_age
+        with self.write_db:
+            stale = [row[0] for row in self.write_db.execute("SELECT channel_id FROM channels WHERE updated < ?", (cutoff,))]
+            self._delete_channels(self.write_db, stale)
+        if stale:
+            logger.info(f"Purged {len(stale)} stale conversations from disk")
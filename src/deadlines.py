@@ -0,0 +1,79 @@
+import asyncio
+from collections import deque
+import aiohttp
+
+PHASES = ("connect", "first_byte", "total")
+
+class DeadlineExceeded(Exception):
+    def __init__(self, url, phase, seconds):
+        super().__init__(f"{url} missed its {phase} deadline of {seconds:g}s")
+        self.url = url
+        self.phase = phase
+
+def parse_deadlines(spec, defaults=None):
+    # "connect=5,first_byte=60,total=600" in seconds on top of the defaults, 0 means no limit
+    deadlines = dict(defaults or {})
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        phase, seconds = part.split("=", 1)
+        if phase.strip() not in PHASES:
+            raise ValueError(f"Unknown deadline {phase!r}, expected one of {', '.join(PHASES)}")
+        deadlines[phase.strip()] = float(seconds) or None
+    return deadlines
+
+class Deadline:
+    # Bounds one backend request: aiohttp enforces the connect deadline, this the time until the response
+    # starts (call started() once it has) and the total, both counted from entering the block
+    def __init__(self, deadlines, url):
+        self.deadlines = deadlines
+        self.url = url
+        self.phase = "first_byte"
+        self.start = None
+        self.timeout = None
+
+    def client_timeout(self):
+        # Replaces the session's timeout for this request, the rest is ours
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.deadlines.get("connect"))
+
+    def _expires(self, phases):
+        ends = [self.start + self.deadlines[phase] for phase in phases if self.deadlines.get(phase)]
+        return min(ends, default=None)
+
+    def started(self):
+        if self.phase == "first_byte":
+            self.phase = "total"
+            self.timeout.reschedule(self._expires(("total",)))
+
+    async def __aenter__(self):
+        self.start = asyncio.get_running_loop().time()
+        self.timeout = asyncio.timeout_at(self._expires(("first_byte", "total")))
+        await self.timeout.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self.timeout.__aexit__(exc_type, exc, tb)
+        except TimeoutError:
+            # Whichever of the two was due first fired
+            phase = self.phase
+            first_byte, total = self.deadlines.get("first_byte"), self.deadlines.get("total")
+            if phase == "first_byte" and (not first_byte or (total and total < first_byte)):
+                phase = "total"
+            raise DeadlineExceeded(self.url, phase, self.deadlines[phase]) from None
+
+class LatencyWindow:
+    # Recent latencies of one kind of request, for hedging once one runs longer than most
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, percent, min_samples=20):
+        # None until there are enough samples to say what "slow" is
+        if len(self.samples) < max(min_samples, 1):
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
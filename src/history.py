@@ -0,0 +1,84 @@
+import re
+import logging
+from .context_store import CHUNK_TOKENS, CHUNK_MESSAGES
+
+logger = logging.getLogger("Bot")
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+DEFAULT_WINDOW = 2048  # Ollama's num_ctx when the model doesn't set one
+
+def parse_budgets(spec):
+    # "4096" applies to every model, "llama2=4096,mistral=8192" sets it per model
+    budgets = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "=" in part:
+            model, tokens = part.rsplit("=", 1)
+            budgets[model.strip()] = int(tokens)
+        else:
+            budgets[None] = int(part)
+    return budgets
+
+def context_window(model, budgets, model_info):
+    # Explicit budget, then the model's num_ctx parameter, then its trained length capped at Ollama's default
+    if model in budgets:
+        return budgets[model]
+    if None in budgets:
+        return budgets[None]
+    if model_info:
+        match = re.search(r"^num_ctx\s+(\d+)", model_info.get("parameters") or "", re.MULTILINE)
+        if match:
+            return int(match.group(1))
+        for key, value in (model_info.get("model_info") or {}).items():
+            if key.endswith(".context_length"):
+                return min(int(value), DEFAULT_WINDOW)
+    return DEFAULT_WINDOW
+
+def estimate_tokens(text, chars_per_token):
+    return int(len(text) / chars_per_token) + 1
+
+def message_tokens(message, chars_per_token):
+    # A few extra tokens for the role markers of the chat template
+    return estimate_tokens(message["content"], chars_per_token) + 4
+
+def is_summary(message):
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+def fit_history(history, budget, chars_per_token):
+    # Drops the oldest user/assistant turns until the history fits, keeping a leading summary. Messages are
+    # dropped a whole stored chunk at a time, so the kept ones still share their chunks with the earlier turns
+    summary = [m for m in history[:1] if is_summary(m)]
+    turns = history[len(summary):]
+    total = sum(message_tokens(m, chars_per_token) for m in history)
+    cut = 0
+    while total > budget and cut < len(turns):
+        total -= message_tokens(turns[cut], chars_per_token)
+        cut += 1
+    # Never start the kept history with an assistant reply
+    while cut < len(turns) and (cut % CHUNK_MESSAGES or turns[cut]["role"] != "user"):
+        total -= message_tokens(turns[cut], chars_per_token)
+        cut += 1
+    return summary + turns[cut:], turns[:cut]
+
+def truncate_context(context, budget):
+    # The opaque context can't be compacted, only its oldest tokens dropped. Whole chunks are dropped, so the
+    # kept tokens start on a chunk boundary and the turn continuing from them shares its chunks with this one
+    if context and budget <= 0:
+        return []
+    if context and len(context) > budget:
+        drop = -(-(len(context) - budget) // CHUNK_TOKENS) * CHUNK_TOKENS
+        return context[drop:]
+    return context
+
+def summary_prompt(summary, dropped):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in dropped)
+    previous = f"{summary['content'][len(SUMMARY_PREFIX):]}\n" if summary else ""
+    return (
+        "Summarize the following conversation in a few sentences, keeping names, facts and decisions.\n\n"
+        f"{previous}{transcript}"
+    )
+
+def summary_message(text):
+    return {"role": "system", "content": SUMMARY_PREFIX + text.strip()}
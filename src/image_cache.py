@@ -0,0 +1,136 @@
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger("Bot")
+
+def derive_seed(prompt):
+    # Stable per prompt, within the positive int32 range every backend accepts
+    return int.from_bytes(hashlib.sha256(prompt.encode()).digest()[:4], "big") & 0x7FFFFFFF
+
+def cache_key(**params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+class ImageCache:
+    # Generated images on disk under the hash of the request that produced them, LRU by access time.
+    # Called from the offload threads: the bookkeeping is under a lock, encoding and file I/O are not
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, image_format="png", quality=90):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.image_format = image_format.lower()
+        self.quality = quality
+        if self.image_format != "png" and Image is None:
+            logger.warning("Pillow is not installed, caching images as PNG")
+            self.image_format = "png"
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> [total bytes, last access]
+        for key in os.listdir(directory):
+            path = os.path.join(directory, key)
+            if key.endswith(".tmp"):
+                # Left over from an interrupted write
+                for name in os.listdir(path):
+                    os.remove(os.path.join(path, name))
+                os.rmdir(path)
+            elif os.path.isdir(path):
+                files = [os.path.join(path, name) for name in os.listdir(path)]
+                self.entries[key] = [sum(os.path.getsize(f) for f in files), os.path.getmtime(path)]
+        self.size = sum(size for size, _ in self.entries.values())
+
+    def _files(self, key):
+        path = os.path.join(self.directory, key)
+        return sorted((os.path.join(path, name) for name in os.listdir(path)), key=lambda f: int(os.path.basename(f).split(".")[0]))
+
+    def get(self, key):
+        # Returns [(bytes, extension)] or None
+        with self.lock:
+            if key not in self.entries:
+                return None
+        try:
+            images = []
+            for file in self._files(key):
+                with open(file, "rb") as f:
+                    images.append((f.read(), file.rsplit(".", 1)[1]))
+            now = time.time()
+            os.utime(os.path.join(self.directory, key), (now, now))
+        except OSError as e:
+            with self.lock:
+                # Unless another thread evicted it meanwhile
+                if key in self.entries:
+                    logger.warning(f"Dropping unreadable image cache entry {key}: {e}")
+                    self._remove(key)
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries[key][1] = now
+        return images
+
+    def encode(self, data):
+        if self.image_format == "png":
+            return data, "png"
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                out = io.BytesIO()
+                image.save(out, format=self.image_format.upper(), quality=self.quality)
+                return out.getvalue(), self.image_format
+        except Exception as e:
+            logger.warning(f"Failed to re-encode image, keeping PNG: {e}")
+            return data, "png"
+
+    def put(self, key, images):
+        # Stores PNG bytes (re-encoded if configured) and returns what was stored as [(bytes, extension)].
+        # Jobs sharing a seeded render put the same key at once, the first one stored is kept
+        stored = self.get(key)
+        if stored:
+            return stored
+        encoded = [self.encode(data) for data in images]
+        path = os.path.join(self.directory, key)
+        tmp = tempfile.mkdtemp(prefix=f"{key}.", suffix=".tmp", dir=self.directory)
+        for i, (data, ext) in enumerate(encoded):
+            with open(os.path.join(tmp, f"{i}.{ext}"), "wb") as f:
+                f.write(data)
+        with self.lock:
+            if key not in self.entries:
+                try:
+                    # Renaming the finished directory makes the entry appear atomically
+                    os.replace(tmp, path)
+                except OSError:
+                    # Another worker process stored it first
+                    pass
+                else:
+                    self.entries[key] = [sum(len(data) for data, _ in encoded), time.time()]
+                    self.size += self.entries[key][0]
+                    self.evict()
+        if os.path.isdir(tmp):
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+        return encoded
+
+    def _remove(self, key):
+        # Callers hold the lock
+        size, _ = self.entries.pop(key)
+        self.size -= size
+        path = os.path.join(self.directory, key)
+        for name in os.listdir(path) if os.path.isdir(path) else []:
+            os.remove(os.path.join(path, name))
+        if os.path.isdir(path):
+            os.rmdir(path)
+
+    def evict(self):
+        if self.size <= self.max_bytes:
+            return
+        for key, _ in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.size <= self.max_bytes:
+                break
+            self._remove(key)
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import struct
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from .offload import run_in_thread
+
+logger = logging.getLogger("Bot")
+
+MAGIC = b"CMEM"
+HEADER = struct.Struct("<4sII")  # Magic, version, dimension
+HEADER_SIZE = 16
+LOCK_STRIPES = 64
+
+class ChannelMemory:
+    # Long-term recall per channel. Every exchange is embedded and appended to two files: the unit vectors
+    # (memory-mapped for search) and one JSON line of text each, row i of one belonging to line i of the
+    # other. Only the few snippets closest to a new message go into its prompt, however long the history.
+    # A channel is only written by the process running its shard. Within it the file I/O and searches run in
+    # the offload threads, serialized per channel by a lock
+    def __init__(self, path, embed, top_k=3, min_score=0.5, max_chars=1000, max_open=256):
+        self.path = path
+        self.embed = embed  # async def embed(text) -> list of floats
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_chars = max_chars
+        self.max_open = max_open
+        self.channels = OrderedDict()  # channel_id -> {"dim", "offsets", "turns": {turn_id: row}, "vectors"}
+        self.lock = threading.Lock()  # Guards self.channels
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        os.makedirs(path, exist_ok=True)
+
+    def _files(self, channel_id):
+        base = os.path.join(self.path, str(channel_id))
+        return base + ".vec", base + ".jsonl"
+
+    def _lock(self, channel_id):
+        # Held around everything touching a channel's files
+        return self.locks[hash(channel_id) % LOCK_STRIPES]
+
+    def _channel(self, channel_id):
+        # Runs in an offload thread, holding the channel's lock
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if channel is not None:
+                self.channels.move_to_end(channel_id)
+                return channel
+        vector_path, text_path = self._files(channel_id)
+        channel = {"dim": None, "offsets": [], "turns": {}, "vectors": None}
+        if os.path.exists(vector_path) and os.path.exists(text_path):
+            with open(vector_path, "rb") as f:
+                header = f.read(HEADER_SIZE)
+            magic, _, dim = HEADER.unpack(header[:HEADER.size]) if len(header) == HEADER_SIZE else (None, 0, 0)
+            if magic == MAGIC and dim:
+                channel["dim"] = dim
+                offset = 0
+                with open(text_path, "rb") as f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        channel["turns"][json.loads(line)["turn"]] = len(channel["offsets"])
+                        channel["offsets"].append(offset)
+                        offset += len(line)
+                rows = (os.path.getsize(vector_path) - HEADER_SIZE) // (4 * dim)
+                if rows != len(channel["offsets"]) or offset != os.path.getsize(text_path):
+                    self._repair(channel, vector_path, text_path, min(rows, len(channel["offsets"])), offset)
+        if channel["dim"] is None:
+            # Nothing usable on disk (e.g. a crash before the first record was complete), start over
+            for path in (vector_path, text_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        with self.lock:
+            self.channels[channel_id] = channel
+            if len(self.channels) > self.max_open:
+                # Closes the least recently used channel's memory map
+                self.channels.popitem(last=False)
+        return channel
+
+    def _repair(self, channel, vector_path, text_path, rows, end):
+        # A crash during an append leaves a partial record or one file a record ahead, drop it
+        logger.warning(f"Truncating {vector_path} to {rows} complete memories")
+        if rows < len(channel["offsets"]):
+            end = channel["offsets"][rows]
+        with open(text_path, "r+b") as f:
+            f.truncate(end)
+        with open(vector_path, "r+b") as f:
+            f.truncate(HEADER_SIZE + rows * 4 * channel["dim"])
+        del channel["offsets"][rows:]
+        channel["turns"] = {turn: row for turn, row in channel["turns"].items() if row < rows}
+
+    def _vectors(self, channel, channel_id):
+        if channel["vectors"] is None and channel["offsets"]:
+            channel["vectors"] = np.memmap(self._files(channel_id)[0], dtype=np.float32, mode="r", offset=HEADER_SIZE,
+                                           shape=(len(channel["offsets"]), channel["dim"]))
+        return channel["vectors"]
+
+    async def _embed(self, text):
+        vector = np.asarray(await self.embed(text), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def remember(self, channel_id, turn_id, text):
+        try:
+            vector = await self._embed(text[:self.max_chars])
+        except Exception as e:
+            logger.warning(f"Failed to embed a memory for {channel_id}: {e}")
+            return
+        await run_in_thread(self._append, channel_id, turn_id, vector, text[:self.max_chars])
+
+    def _append(self, channel_id, turn_id, vector, text):
+        with self._lock(channel_id):
+            channel = self._channel(channel_id)
+            if channel["dim"] is not None and channel["dim"] != len(vector):
+                logger.warning(f"Memory of {channel_id} was embedded with {channel['dim']} dimensions, not {len(vector)}; not adding to it")
+                return
+            vector_path, text_path = self._files(channel_id)
+            with open(vector_path, "ab") as f:
+                if channel["dim"] is None:
+                    f.write(HEADER.pack(MAGIC, 1, len(vector)).ljust(HEADER_SIZE, b"\0"))
+                    channel["dim"] = len(vector)
+                f.write(vector.tobytes())
+            with open(text_path, "ab") as f:
+                offset = f.tell()
+                f.write(json.dumps({"turn": turn_id, "time": time.time(), "text": text}).encode() + b"\n")
+            channel["turns"][turn_id] = len(channel["offsets"])
+            channel["offsets"].append(offset)
+            # Remapped with the new row on the next search
+            channel["vectors"] = None
+
+    async def recall(self, channel_id, query, exclude=()):
+        # Texts of the closest memories, best first, leaving out the turns in exclude (still in the prompt)
+        if not await run_in_thread(self._size, channel_id):
+            return []
+        try:
+            vector = await self._embed(query)
+        except Exception as e:
+            logger.warning(f"Failed to embed a query for the memory of {channel_id}: {e}")
+            return []
+        return await run_in_thread(self._search, channel_id, vector, exclude)
+
+    def _size(self, channel_id):
+        with self._lock(channel_id):
+            return len(self._channel(channel_id)["offsets"])
+
+    def _search(self, channel_id, vector, exclude):
+        with self._lock(channel_id):
+            channel = self._channel(channel_id)
+            if not channel["offsets"] or len(vector) != channel["dim"]:
+                return []
+            scores = np.asarray(self._vectors(channel, channel_id) @ vector)
+            excluded = [channel["turns"][turn] for turn in exclude if turn in channel["turns"]]
+            scores[excluded] = -np.inf
+            k = min(self.top_k, len(scores))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = [int(row) for row in best[np.argsort(-scores[best])] if scores[row] >= self.min_score]
+            texts = []
+            with open(self._files(channel_id)[1], "rb") as f:
+                for row in best:
+                    f.seek(channel["offsets"][row])
+                    texts.append(json.loads(f.readline())["text"])
+            return texts
+
+    async def forget(self, channel_id):
+        # Returns the amount of memories deleted
+        return await run_in_thread(self._delete, channel_id)
+
+    def _delete(self, channel_id):
+        with self._lock(channel_id):
+            amount = len(self._channel(channel_id)["offsets"])
+            with self.lock:
+                self.channels.pop(channel_id, None)
+            for path in self._files(channel_id):
+                if os.path.exists(path):
+                    os.remove(path)
+            return amount
@@ -0,0 +1,226 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from aiohttp import web
+
+logger = logging.getLogger("Bot")
+
+# Seconds, from a quick Discord call up to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200, 300, 500)
+
+registry = []
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}  # Label values tuple -> value
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect  # Optional callable returning {label values tuple: value}, read at scrape time
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.collect:
+            self.values = dict(self.collect())
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Per-bucket counts (made cumulative when rendered), sum, count
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f"{self.name}_bucket", format_labels(self.labels, key, [("le", format_value(float(bound)))]), cumulative
+            yield f"{self.name}_bucket", format_labels(self.labels, key, [("le", "+Inf")]), count
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+            yield f"{self.name}_count", format_labels(self.labels, key), count
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+async def timed(histogram, awaitable, **labels):
+    # Awaits and records how long it took, failures included
+    start = time.monotonic()
+    try:
+        return await awaitable
+    finally:
+        histogram.observe(time.monotonic() - start, **labels)
+
+# Hot paths
+queue_wait = Histogram("bot_queue_wait_seconds", "Time a job waited before its generation started", ("queue",))
+backend_latency = Histogram("bot_backend_request_seconds", "Duration of backend requests, body included", ("backend", "server"))
+backend_errors = Counter("bot_backend_errors_total", "Failed backend requests", ("backend", "server"))
+deadlines_missed = Counter("bot_backend_deadlines_missed_total", "Backend requests cut off by a deadline: first_byte or total", ("backend", "phase"))
+hedged_requests = Counter("bot_hedged_requests_total", "Slow requests raced on a second server, by which copy answered: primary or hedge", ("backend", "winner"))
+in_flight = Gauge("bot_backend_in_flight", "Requests currently running on a backend server", ("backend", "server"))
+time_to_first_token = Histogram("bot_time_to_first_token_seconds", "Time from sending a generation to its first token", ("model",))
+discord_latency = Histogram("bot_discord_request_seconds", "Duration of Discord API calls", ("operation",))
+loop_stalls = Counter("bot_event_loop_stalls_total", "Times the event loop was blocked past the watchdog threshold")
+loop_lag = Histogram("bot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task", buckets=LAG_BUCKETS)
+reference_lookups = Counter("bot_reference_lookups_total", "How replied-to messages were resolved: index, resolved or fetch", ("source",))
+commands = Counter("bot_commands_total", "Handled commands and chat messages", ("command",))
+command_errors = Counter("bot_command_errors_total", "Commands and chat messages that ended in an error", ("command",))
+cancellations = Counter("bot_cancellations_total", "Jobs dropped or aborted before they finished: stop, reset, deleted or superseded", ("command", "reason"))
+rejections = Counter("bot_rejections_total", "Requests turned away by quotas (quota) or a full queue (busy)", ("command", "reason"))
+context_store_turns = Gauge("bot_context_store_turns", "Conversation turns held in memory")
+context_store_bytes = Gauge("bot_context_store_bytes", "Estimated memory used by held conversation turns")
+tokens_per_second = Histogram("bot_generation_tokens_per_second", "Generation speed reported by Ollama", ("model",), buckets=TOKEN_RATE_BUCKETS)
+generated_tokens = Counter("bot_generated_tokens_total", "Tokens generated by Ollama", ("model",))
+prompt_tokens = Counter("bot_prompt_tokens_total", "Prompt tokens evaluated by Ollama", ("model",))
+
+def record_generation(model, done):
+    # Ollama's final object reports token counts and durations in nanoseconds
+    eval_count = done.get("eval_count") or 0
+    eval_duration = done.get("eval_duration") or 0
+    if eval_count and eval_duration:
+        tokens_per_second.observe(eval_count / (eval_duration / 1e9), model=model)
+    generated_tokens.inc(eval_count, model=model)
+    prompt_tokens.inc(done.get("prompt_eval_count") or 0, model=model)
+
+async def loop_lag_monitor(interval=0.5):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(time.monotonic() - start - interval, 0.0))
+
+class LoopWatchdog:
+    # A thread that notices when the event loop stops running and logs the stack it is stuck in, which
+    # points at the blocking call while it is still blocking. Works without the exporter
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.beat = time.monotonic()
+        self.loop = None
+        self.handle = None
+        self.thread_id = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        # Called from the loop's thread
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self._tick()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle:
+            self.handle.cancel()
+
+    def _tick(self):
+        self.beat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            # Once per stall, while it's still happening
+            reported = beat
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            loop_stalls.inc()
+            logger.warning(f"Event loop blocked for {blocked:.2f}s so far, in:\n{stack}")
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+# Server runner and lag monitor while the exporter is running, the watchdog while the bot is
+state = {"runner": None, "tasks": [], "watchdog": None}
+
+def start_watchdog(threshold):
+    state["watchdog"] = LoopWatchdog(threshold)
+    state["watchdog"].start()
+
+def stop_watchdog():
+    if state["watchdog"]:
+        state["watchdog"].stop()
+        state["watchdog"] = None
+
+async def start_metrics(host, port, lag_interval=0.5):
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    state["runner"] = runner
+    state["tasks"].append(asyncio.create_task(loop_lag_monitor(lag_interval)))
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+async def stop_metrics():
+    while state["tasks"]:
+        state["tasks"].pop().cancel()
+    if state["runner"]:
+        await state["runner"].cleanup()
+        state["runner"] = None
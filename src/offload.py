@@ -0,0 +1,93 @@
+import os
+import json
+import base64
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .text import split_text
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("Bot")
+
+# CPU work above these sizes leaves the event loop that runs every shard's heartbeat. JSON parsing,
+# base64 decoding and split_text hold the GIL and go to processes; threads are for work that releases it
+# (file I/O, Pillow's encoders). Kept free of the bot's own modules so spawned workers import little
+OFFLOAD_THREADS = int(os.getenv("OFFLOAD_THREADS", "4"))
+OFFLOAD_PROCESSES = int(os.getenv("OFFLOAD_PROCESSES", "2"))  # 0 runs process work in the threads instead
+OFFLOAD_JSON_BYTES = int(os.getenv("OFFLOAD_JSON_BYTES", str(512 * 1024)))
+OFFLOAD_TEXT_CHARS = int(os.getenv("OFFLOAD_TEXT_CHARS", str(64 * 1024)))
+OFFLOAD_BASE64_BYTES = int(os.getenv("OFFLOAD_BASE64_BYTES", str(256 * 1024)))
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson" if orjson else "json").lower()
+
+if JSON_BACKEND == "orjson" and orjson is None:
+    logger.warning("JSON_BACKEND is orjson but orjson is not installed, using json")
+    JSON_BACKEND = "json"
+
+def loads(data):
+    # str or bytes; orjson's errors are json.JSONDecodeError too
+    if JSON_BACKEND == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+pools = {"thread": None, "process": None}
+
+def thread_pool():
+    if pools["thread"] is None:
+        pools["thread"] = ThreadPoolExecutor(max(OFFLOAD_THREADS, 1), thread_name_prefix="offload")
+    return pools["thread"]
+
+def process_pool():
+    if OFFLOAD_PROCESSES <= 0:
+        return thread_pool()
+    if pools["process"] is None:
+        # Forking a process that runs an event loop and network threads isn't safe
+        pools["process"] = ProcessPoolExecutor(OFFLOAD_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return pools["process"]
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(thread_pool(), func, *args)
+
+async def run_in_process(func, *args):
+    try:
+        return await asyncio.get_running_loop().run_in_executor(process_pool(), func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory), the next call starts a fresh pool
+        pools["process"] = None
+        raise
+
+async def decode_json(data):
+    if len(data) >= OFFLOAD_JSON_BYTES:
+        return await run_in_process(loads, data)
+    return loads(data)
+
+async def b64decode_all(items):
+    # One call per item so a batch spreads over the workers
+    if sum(len(item) for item in items) < OFFLOAD_BASE64_BYTES:
+        return [base64.b64decode(item) for item in items]
+    return await asyncio.gather(*(run_in_process(base64.b64decode, item) for item in items))
+
+async def split(text, length):
+    if len(text) >= OFFLOAD_TEXT_CHARS:
+        return await run_in_process(split_text, text, length)
+    return split_text(text, length)
+
+async def start():
+    # Spawning workers takes a moment, better at startup than on the first long answer
+    if OFFLOAD_PROCESSES > 0:
+        try:
+            await run_in_process(int)
+        except Exception as e:
+            logger.warning(f"Offload processes failed to start, using threads: {e}")
+            pools["process"] = thread_pool()
+
+def shutdown():
+    for name, pool in pools.items():
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            pools[name] = None
@@ -0,0 +1,156 @@
+import io
+import re
+import time
+import asyncio
+import disnake
+from . import metrics
+from .offload import split
+
+MESSAGE_LIMIT = 2000
+EMBED_LIMIT = 4096  # Characters in one embed description
+EMBEDS_TOTAL = 6000  # Characters across all embeds of one message
+EMBEDS_PER_MESSAGE = 10
+PREVIEW_LIMIT = 1500
+MARKDOWN_PATTERN = re.compile(r"^(```|#{1,6} |\s*[-*] |\s*\d+\. )", re.MULTILINE)
+
+class SendQueue:
+    # Paces Discord calls per channel with a token bucket shaped like Discord's per-channel limit (5 per 5s),
+    # so a long answer waits its turn locally instead of hitting 429s that stall every reply in the channel.
+    # Calls for one channel run one at a time, in order
+    def __init__(self, rate=1.0, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # channel_id -> {"tokens", "updated", "lock"}
+
+    async def run(self, channel_id, operation, call):
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            self._prune()
+            bucket = self.buckets[channel_id] = {"tokens": self.burst, "updated": time.monotonic(), "lock": asyncio.Lock()}
+        async with bucket["lock"]:
+            self._refill(bucket)
+            if bucket["tokens"] < 1:
+                await asyncio.sleep((1 - bucket["tokens"]) / self.rate)
+                self._refill(bucket)
+            bucket["tokens"] -= 1
+            return await metrics.timed(metrics.discord_latency, call(), operation=operation)
+
+    def _refill(self, bucket):
+        now = time.monotonic()
+        bucket["tokens"] = min(self.burst, bucket["tokens"] + (now - bucket["updated"]) * self.rate)
+        bucket["updated"] = now
+
+    def _prune(self):
+        # Idle buckets that refilled completely carry no state worth keeping
+        if len(self.buckets) < 256:
+            return
+        for channel_id, bucket in list(self.buckets.items()):
+            if not bucket["lock"].locked():
+                self._refill(bucket)
+                if bucket["tokens"] >= self.burst:
+                    del self.buckets[channel_id]
+
+def answer_file(text, name="answer"):
+    extension = "md" if MARKDOWN_PATTERN.search(text) else "txt"
+    return disnake.File(io.BytesIO(text.encode()), filename=f"{name}.{extension}")
+
+class PageView(disnake.ui.View):
+    # One message showing one page at a time, flipped with buttons
+    def __init__(self, pages, timeout=900):
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.page = 0
+        self.message = None
+        self._update()
+
+    def render(self):
+        return f"{self.pages[self.page]}\n\n*Page {self.page + 1}/{len(self.pages)}*"
+
+    def _update(self):
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page == len(self.pages) - 1
+
+    @disnake.ui.button(label="◀", style=disnake.ButtonStyle.secondary)
+    async def previous(self, button, inter):
+        self.page = max(self.page - 1, 0)
+        await self._show(inter)
+
+    @disnake.ui.button(label="▶", style=disnake.ButtonStyle.secondary)
+    async def next(self, button, inter):
+        self.page = min(self.page + 1, len(self.pages) - 1)
+        await self._show(inter)
+
+    async def _show(self, inter):
+        self._update()
+        await inter.response.edit_message(content=self.render(), view=self)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except disnake.HTTPException:
+                pass
+
+class Outbound:
+    # Sends an answer as plain messages ("split"), embeds ("embed"), a preview with the full text attached
+    # ("file") or one paginated message ("pages"), using at most max_calls API calls per answer
+    def __init__(self, mode="split", max_calls=5, queue=None, page_timeout=900):
+        self.mode = mode
+        self.max_calls = max(max_calls, 1)
+        self.queue = queue or SendQueue()
+        self.page_timeout = page_timeout
+
+    async def reply(self, message, text):
+        # Returns the sent messages, the first one replying to message
+        if len(text) <= MESSAGE_LIMIT:
+            return await self._send(message, [{"content": text}])
+        if self.mode == "embed":
+            return await self._send(message, await self._embed_messages(text))
+        if self.mode == "file":
+            return await self._send(message, [await self._preview(text)])
+        if self.mode == "pages":
+            return await self._send_pages(message, text)
+        return await self._send(message, [{"content": segment} for segment in await split(text, MESSAGE_LIMIT)])
+
+    async def _embed_messages(self, text):
+        # Two embeds of this size fill a message's total embed budget
+        size = min(EMBED_LIMIT, EMBEDS_TOTAL // 2)
+        messages = []
+        total = EMBEDS_TOTAL
+        for segment in await split(text, size):
+            if total + len(segment) > EMBEDS_TOTAL or len(messages[-1]["embeds"]) >= EMBEDS_PER_MESSAGE:
+                messages.append({"embeds": []})
+                total = 0
+            messages[-1]["embeds"].append(disnake.Embed(description=segment))
+            total += len(segment)
+        return messages
+
+    async def _preview(self, text):
+        preview = (await split(text, PREVIEW_LIMIT))[0]
+        return {"content": f"{preview}\n\n*Full answer attached*", "file": answer_file(text)}
+
+    def _cap(self, messages):
+        # Past the cap the last message becomes a note with the remaining text attached
+        if len(messages) <= self.max_calls:
+            return messages
+        kept = messages[:self.max_calls - 1]
+        rest = "\n\n".join(
+            m.get("content") or "\n\n".join(embed.description for embed in m.get("embeds", []))
+            for m in messages[self.max_calls - 1:]
+        )
+        return kept + [{"content": "*The rest of the answer is attached*", "file": answer_file(rest, "rest")}]
+
+    async def _send(self, message, messages):
+        sent = []
+        for i, kwargs in enumerate(self._cap(messages)):
+            if i == 0:
+                sent.append(await self.queue.run(message.channel.id, "send", lambda: message.reply(**kwargs)))
+            else:
+                sent.append(await self.queue.run(message.channel.id, "send", lambda: message.channel.send(**kwargs)))
+        return sent
+
+    async def _send_pages(self, message, text):
+        # Leave room for the page footer
+        view = PageView(await split(text, MESSAGE_LIMIT - 32), self.page_timeout)
+        view.message = await self.queue.run(message.channel.id, "send", lambda: message.reply(content=view.render(), view=view))
+        return [view.message]
@@ -0,0 +1,92 @@
+import re
+import time
+import logging
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger("Bot")
+
+def normalize_prompt(prompt):
+    # Case, spacing and trailing punctuation don't change the question
+    return re.sub(r"\s+", " ", prompt).strip().lower().rstrip("?!. ")
+
+class ResponseCache:
+    # Answers to context-free prompts, looked up by exact key first and then by embedding similarity
+    def __init__(self, max_entries=1000, ttl=86400.0, threshold=0.95, embed=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embed = embed  # async def embed(text) -> list of floats, or None for exact matching only
+        self.entries = OrderedDict()  # (model, system, prompt) -> {"text", "context", "vector", "time"}
+        self.indexes = {}  # (model, system) -> (keys, matrix of unit vectors), rebuilt when entries change
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _expired(self, entry):
+        return time.monotonic() - entry["time"] > self.ttl
+
+    def _index(self, group):
+        index = self.indexes.get(group)
+        if index is None:
+            keys = [key for key, entry in self.entries.items() if key[:2] == group and entry["vector"] is not None]
+            matrix = np.stack([self.entries[key]["vector"] for key in keys]) if keys else None
+            index = self.indexes[group] = (keys, matrix)
+        return index
+
+    async def lookup(self, model, system, prompt):
+        # Returns (entry or None, vector) so a miss can be stored without embedding the prompt twice
+        key = (model, system, normalize_prompt(prompt))
+        entry = self.entries.get(key)
+        if entry is not None and self._expired(entry):
+            self._remove(key)
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry, entry["vector"]
+
+        vector = None
+        if self.embed:
+            try:
+                embedding = await self.embed(key[2])
+                if embedding:
+                    vector = np.asarray(embedding, dtype=np.float32)
+                    vector /= np.linalg.norm(vector) or 1.0
+            except Exception as e:
+                logger.warning(f"Failed to embed prompt for the response cache: {e}")
+        if vector is not None:
+            keys, matrix = self._index(key[:2])
+            if matrix is not None and matrix.shape[1] == vector.shape[0]:
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                entry = self.entries.get(keys[best])
+                if scores[best] >= self.threshold and entry is not None and not self._expired(entry):
+                    self.entries.move_to_end(keys[best])
+                    self.similar_hits += 1
+                    logger.debug(f"Response cache similarity hit ({scores[best]:.3f}): {keys[best][2]}")
+                    return entry, vector
+
+        self.misses += 1
+        return None, vector
+
+    def store(self, model, system, prompt, text, context=None, vector=None):
+        key = (model, system, normalize_prompt(prompt))
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = {"text": text, "context": context, "vector": vector, "time": time.monotonic()}
+        self.indexes.pop(key[:2], None)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        del self.entries[key]
+        self.indexes.pop(key[:2], None)
+
+    def stats(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        rate = (self.hits + self.similar_hits) / lookups if lookups else 0.0
+        return f"{len(self.entries)} entries, {self.hits} exact hits, {self.similar_hits} similar hits, {self.misses} misses ({rate:.0%} hit rate)"
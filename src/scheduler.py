@@ -0,0 +1,351 @@
+import json
+import time
+import random
+import asyncio
+import itertools
+import logging
+import aiohttp
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("Bot")
+
+class NoServersAvailable(Exception):
+    def __init__(self, name):
+        super().__init__(f"No {name} servers available")
+
+def model_key(name):
+    # Ollama reports "llama3:latest" for a model requested as "llama3"
+    return name if ":" in name else name + ":latest"
+
+class Server:
+    def __init__(self, url, slots=1):
+        self.url = url
+        self.slots = slots
+        self.outstanding = 0
+        self.latency = None  # EWMA of seconds until the response started
+        self.failures = 0
+        self.open_until = 0.0  # Circuit breaker: ejected until this monotonic time
+        self.models = {}  # Resident model -> monotonic time it's expected to be unloaded
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.open_until
+
+    @property
+    def free(self):
+        return self.healthy and self.outstanding < self.slots
+
+    def has_model(self, model):
+        return self.models.get(model_key(model), 0.0) > time.monotonic()
+
+    def url_for(self, path):
+        base_url = self.url if self.url.endswith("/") else self.url + "/"
+        return base_url + path.lstrip("/")
+
+    def record_success(self, elapsed, alpha):
+        self.latency = elapsed if self.latency is None else alpha * elapsed + (1 - alpha) * self.latency
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, threshold, cooldown):
+        self.failures += 1
+        # After the cooldown a single probe decides (half-open): one more failure ejects it again
+        if self.failures >= threshold:
+            if self.healthy:
+                logger.warning(f"Ejecting {self.url} for {cooldown:.0f}s after {self.failures} failures")
+            self.open_until = time.monotonic() + cooldown
+
+class ServerPool:
+    # Hands out per-server concurrency slots, waking waiters as soon as a slot is released
+    def __init__(self, name, urls, slots=(1,), strategy="least_outstanding", health_path="/",
+                 health_interval=30.0, failure_threshold=3, cooldown=30.0, ewma_alpha=0.3, shuffle=False,
+                 models_path=None, keep_alive=300.0):
+        urls = [url for url in urls if url]
+        slots = list(slots) or [1]
+        self.name = name
+        self.servers = [Server(url, slots[i] if i < len(slots) else slots[-1]) for i, url in enumerate(urls)]
+        self.strategy = strategy
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self.shuffle = shuffle
+        self.models_path = models_path  # Endpoint listing resident models (Ollama's /api/ps), polled with the health checks
+        self.keep_alive = keep_alive  # Seconds a model stays loaded after its last request
+        self.condition = asyncio.Condition()
+
+    def _score(self, server):
+        # Unknown latency counts as the best known one so new servers get tried
+        known = [s.latency for s in self.servers if s.latency is not None]
+        latency = server.latency if server.latency is not None else min(known, default=1.0)
+        if self.strategy == "ewma":
+            return ((server.outstanding + 1) * latency, server.outstanding / server.slots)
+        return (server.outstanding / server.slots, latency)
+
+    def _affinity(self, server, model, sticky):
+        # Servers with the model loaded avoid a swap, the conversation's last server may still have its prompt cached
+        return (not server.has_model(model) if model else False, server.url != sticky)
+
+    def _pick(self, exclude, model=None, sticky=None):
+        candidates = [s for s in self.servers if s not in exclude and s.free]
+        if not candidates:
+            return None
+        if self.shuffle:
+            # Random tie-break between equally loaded servers
+            random.shuffle(candidates)
+        return min(candidates, key=lambda s: (self._affinity(s, model, sticky), self._score(s)))
+
+    async def acquire(self, exclude=(), model=None, sticky=None, wait=True):
+        # Only free servers are considered, a busy preferred server is not waited for;
+        # without wait, a pool with no free server counts as having none
+        async with self.condition:
+            while True:
+                if not any(s.healthy for s in self.servers if s not in exclude):
+                    raise NoServersAvailable(self.name)
+                server = self._pick(exclude, model, sticky)
+                if server:
+                    server.outstanding += 1
+                    return server
+                if not wait:
+                    raise NoServersAvailable(self.name)
+                await self.condition.wait()
+
+    async def release(self, server):
+        # Freed before waiting for the lock, so a request cancelled again while it cleans up can't leak its slot
+        server.outstanding -= 1
+        async with self.condition:
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, exclude=()):
+        server = await self.acquire(exclude)
+        try:
+            yield server
+        finally:
+            await self.release(server)
+
+    def record_success(self, server, elapsed, model=None):
+        server.record_success(elapsed, self.ewma_alpha)
+        if model:
+            self.record_model(server, model)
+
+    def record_model(self, server, model):
+        server.models[model_key(model)] = time.monotonic() + self.keep_alive
+
+    async def record_failure(self, server):
+        server.record_failure(self.failure_threshold, self.cooldown)
+        # Waiters may have to give up now that fewer servers are healthy
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def check_health(self, session):
+        timeout = aiohttp.ClientTimeout(total=5)
+        for server in self.servers:
+            try:
+                async with session.get(server.url_for(self.health_path), timeout=timeout) as response:
+                    response.raise_for_status()
+                ejected = not server.healthy
+                # Probes are much cheaper than real requests, so they don't feed the latency EWMA
+                server.reset()
+                if self.models_path:
+                    await self.update_models(session, server)
+                if ejected:
+                    logger.info(f"{server.url} is healthy again")
+                    async with self.condition:
+                        self.condition.notify_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.debug(f"Health check of {server.url} failed: {err}")
+                await self.record_failure(server)
+
+    async def update_models(self, session, server):
+        # The server's own list replaces what we assumed from earlier requests
+        try:
+            async with session.get(server.url_for(self.models_path), timeout=aiohttp.ClientTimeout(total=5)) as response:
+                response.raise_for_status()
+                data = await response.json()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.debug(f"Failed to list the models loaded on {server.url}: {err}")
+            return
+        # Resident until the next poll at least, or for keep_alive when nothing refreshes it
+        until = time.monotonic() + max(self.health_interval, self.keep_alive)
+        server.models = {model_key(m.get("name") or m.get("model", "")): until for m in data.get("models") or []}
+
+    async def health_check_loop(self, session_factory):
+        while True:
+            await self.check_health(session_factory())
+            await asyncio.sleep(self.health_interval)
+
+async def open_stream(address):
+    # "tcp://host:port" or the path of a Unix socket
+    if address.startswith("tcp://"):
+        host, port = address[len("tcp://"):].rsplit(":", 1)
+        return await asyncio.open_connection(host, int(port), limit=1024 * 1024)
+    return await asyncio.open_unix_connection(address, limit=1024 * 1024)
+
+class PoolServer:
+    # Shares ServerPools with other processes, so slots and circuit breakers are global across a cluster.
+    # One JSON object per line; slots still leased by a client that disconnects are released
+    def __init__(self, pools):
+        self.pools = pools  # name -> ServerPool
+        self.server = None
+
+    async def start(self, address):
+        if address.startswith("tcp://"):
+            host, port = address[len("tcp://"):].rsplit(":", 1)
+            self.server = await asyncio.start_server(self.handle, host, int(port), limit=1024 * 1024)
+            host, port = self.server.sockets[0].getsockname()[:2]
+            return f"tcp://{host}:{port}"
+        self.server = await asyncio.start_unix_server(self.handle, address, limit=1024 * 1024)
+        return address
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def handle(self, reader, writer):
+        leases = []  # (pool, server) pairs held by this client
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self._serve(json.loads(line), leases, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, json.JSONDecodeError) as err:
+            logger.warning(f"Dropping scheduler client: {err}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if leases:
+                logger.warning(f"Releasing {len(leases)} slots of a disconnected scheduler client")
+            for pool, server in leases:
+                await pool.release(server)
+            writer.close()
+
+    async def _serve(self, request, leases, writer):
+        pool = self.pools[request["pool"]]
+        servers = {server.url: server for server in pool.servers}
+        server = servers.get(request.get("url"))
+        result = {}
+        if request["op"] == "acquire":
+            try:
+                exclude = [servers[url] for url in request["exclude"] if url in servers]
+                server = await pool.acquire(exclude, request.get("model"), request.get("sticky"), request.get("wait", True))
+                leases.append((pool, server))
+                result["url"] = server.url
+            except NoServersAvailable:
+                result["url"] = None
+        elif request["op"] == "release":
+            if (pool, server) in leases:
+                leases.remove((pool, server))
+                await pool.release(server)
+        elif request["op"] == "success":
+            pool.record_success(server, request["elapsed"], request.get("model"))
+        elif request["op"] == "failure":
+            await pool.record_failure(server)
+        if request.get("id") is not None:
+            result["id"] = request["id"]
+            writer.write((json.dumps(result) + "\n").encode())
+
+class RemotePool:
+    # ServerPool stand-in for cluster workers: scheduling decisions are made by the PoolServer in the
+    # launcher, the local Server objects only track this process's own requests
+    def __init__(self, name, urls, slots=(1,), address=None):
+        urls = [url for url in urls if url]
+        slots = list(slots) or [1]
+        self.name = name
+        self.servers = [Server(url, slots[i] if i < len(slots) else slots[-1]) for i, url in enumerate(urls)]
+        self.address = address
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.pending = {}  # Request ID -> future
+        self.ids = itertools.count()
+        self.connecting = asyncio.Lock()
+
+    async def _connect(self):
+        async with self.connecting:
+            if self.writer is None:
+                self.reader, self.writer = await open_stream(self.address)
+                self.read_task = asyncio.create_task(self._read(self.reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self.pending.pop(response["id"], None)
+                if future and not future.done():
+                    future.set_result(response)
+        finally:
+            # Whatever was in flight died with the connection, the next call reconnects
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Lost the {self.name} scheduler"))
+            self.pending.clear()
+
+    def _send(self, request):
+        if self.writer is not None:
+            self.writer.write((json.dumps(request) + "\n").encode())
+
+    async def _call(self, request):
+        await self._connect()
+        request["id"] = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request["id"]] = future
+        self._send(request)
+        try:
+            return await future
+        finally:
+            self.pending.pop(request["id"], None)
+
+    async def acquire(self, exclude=(), model=None, sticky=None, wait=True):
+        call = asyncio.ensure_future(self._call({"op": "acquire", "pool": self.name, "exclude": [s.url for s in exclude],
+                                                 "model": model, "sticky": sticky, "wait": wait}))
+        try:
+            response = await asyncio.shield(call)
+        except asyncio.CancelledError:
+            # The launcher may still grant the slot, which nobody would release then
+            call.add_done_callback(self._release_late)
+            raise
+        if response["url"] is None:
+            raise NoServersAvailable(self.name)
+        server = next(s for s in self.servers if s.url == response["url"])
+        server.outstanding += 1
+        return server
+
+    async def release(self, server):
+        server.outstanding -= 1
+        self._send({"op": "release", "pool": self.name, "url": server.url})
+
+    def _release_late(self, call):
+        if not call.cancelled() and not call.exception() and call.result()["url"]:
+            self._send({"op": "release", "pool": self.name, "url": call.result()["url"]})
+
+    @asynccontextmanager
+    async def slot(self, exclude=()):
+        server = await self.acquire(exclude)
+        try:
+            yield server
+        finally:
+            await self.release(server)
+
+    def record_success(self, server, elapsed, model=None):
+        self._send({"op": "success", "pool": self.name, "url": server.url, "elapsed": elapsed, "model": model})
+
+    async def record_failure(self, server):
+        self._send({"op": "failure", "pool": self.name, "url": server.url})
@@ -0,0 +1,245 @@
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from . import metrics
+
+logger = logging.getLogger("Bot")
+
+# Fields that may differ between jobs sharing one backend call
+BATCH_FIELDS = ("batch_size", "batch_count")
+
+class JobCancelled(Exception):
+    def __init__(self):
+        super().__init__("The text2img job was cancelled")
+
+def batch_key(payload):
+    return json.dumps({k: v for k, v in payload.items() if k not in BATCH_FIELDS}, sort_keys=True)
+
+def image_count(payload):
+    return payload.get("batch_size", 1) * payload.get("batch_count", 1)
+
+class Text2ImgQueue:
+    # Round-robin across users; compatible pending jobs are merged into one batched txt2img call
+    def __init__(self, request, progress, workers=1, max_batch=8, progress_interval=2.0, interrupt=None):
+        self.request = request  # async def request(payload, on_server) -> response dict
+        self.progress = progress  # async def progress(server) -> /sdapi/v1/progress response
+        self.interrupt = interrupt  # async def interrupt(server), stops the server's current render
+        self.workers = workers
+        self.max_batch = max_batch
+        self.progress_interval = progress_interval
+        self.pending = OrderedDict()  # user_id -> deque of jobs
+        self.turns = deque()  # User IDs in round-robin order
+        self.ready = asyncio.Condition()
+        self.tasks = []
+        self.running = 0
+        self.batches = []  # {"jobs", "stop": Event} of the batches being rendered
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.pending.values())
+
+    def start(self):
+        while len(self.tasks) < self.workers:
+            self.tasks.append(asyncio.create_task(self._work()))
+
+    def stop(self):
+        while self.tasks:
+            self.tasks.pop().cancel()
+
+    def position(self, job):
+        # Jobs that will be dispatched before this one under round-robin, plus a batch in progress
+        user_id = job["user_id"]
+        mine = self.pending[user_id].index(job)
+        ahead = self._ahead(user_id)
+        position = mine + (1 if self.running >= self.workers else 0)
+        for other_id, jobs in self.pending.items():
+            if other_id != user_id:
+                position += min(len(jobs), mine + (1 if other_id in ahead else 0))
+        return position
+
+    def _ahead(self, user_id):
+        turns = list(self.turns)
+        return set(turns[:turns.index(user_id)]) if user_id in turns else set()
+
+    async def submit(self, user_id, payload, on_progress=None, channel_id=None):
+        # Returns the base64 images for this job once its batch is done, raises JobCancelled if cancel() took it
+        job = {
+            "user_id": user_id,
+            "channel_id": channel_id,
+            "payload": payload,
+            "key": batch_key(payload),
+            "count": image_count(payload),
+            "seeded": payload.get("seed", -1) >= 0,
+            "future": asyncio.get_running_loop().create_future(),
+            "on_progress": on_progress,
+            "queued": time.monotonic()
+        }
+        self.start()
+        async with self.ready:
+            if user_id not in self.pending:
+                self.pending[user_id] = deque()
+                self.turns.append(user_id)
+            self.pending[user_id].append(job)
+            self.ready.notify()
+            position = self.position(job)
+        if position > 0:
+            await self._report(job, f"Queued, position {position}")
+        try:
+            return await job["future"]
+        finally:
+            # A cancelled caller must not keep its job in line
+            self._discard(job)
+
+    def cancel(self, channel_id, user_id=None):
+        # Cancels the jobs requested in the channel, or only one user's there; a batch left with nothing
+        # but cancelled jobs stops rendering. Returns the amount of jobs cancelled
+        matches = lambda job: job["channel_id"] == channel_id and (user_id is None or job["user_id"] == user_id)
+        cancelled = 0
+        for jobs in list(self.pending.values()):
+            for job in [job for job in jobs if matches(job)]:
+                self._discard(job)
+                if not job["future"].done():
+                    job["future"].set_exception(JobCancelled())
+                    cancelled += 1
+        for batch in self.batches:
+            for job in batch["jobs"]:
+                if matches(job) and not job["future"].done():
+                    job["future"].set_exception(JobCancelled())
+                    cancelled += 1
+            if all(job["future"].done() for job in batch["jobs"]):
+                batch["stop"].set()
+        return cancelled
+
+    def _discard(self, job):
+        jobs = self.pending.get(job["user_id"])
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self.pending[job["user_id"]]
+                self.turns.remove(job["user_id"])
+
+    def _take(self):
+        # Next user's oldest job, plus every compatible pending job that still fits in the batch
+        user_id = self.turns.popleft()
+        first = self.pending[user_id].popleft()
+        batch = [first]
+        total = first["count"]
+        for other_id in list(self.turns) + [user_id]:
+            jobs = self.pending[other_id]
+            for job in list(jobs):
+                if job["key"] != first["key"]:
+                    continue
+                if first["seeded"]:
+                    # A pinned seed renders the same images, so identical jobs just share them,
+                    # as long as the render makes at least as many as the job wants
+                    if job["count"] <= first["count"]:
+                        jobs.remove(job)
+                        batch.append(job)
+                elif total + job["count"] <= self.max_batch:
+                    jobs.remove(job)
+                    batch.append(job)
+                    total += job["count"]
+        for other_id in list(self.pending):
+            if not self.pending[other_id]:
+                del self.pending[other_id]
+                if other_id in self.turns:
+                    self.turns.remove(other_id)
+        if user_id in self.pending:
+            # The user goes to the back of the line
+            self.turns.append(user_id)
+        return batch
+
+    async def _work(self):
+        while True:
+            async with self.ready:
+                await self.ready.wait_for(lambda: self.turns)
+                batch = self._take()
+                self.running += 1
+            try:
+                await self._run(batch)
+            finally:
+                self.running -= 1
+
+    async def _run(self, batch):
+        payload = dict(batch[0]["payload"])
+        total = batch[0]["count"] if batch[0]["seeded"] else sum(job["count"] for job in batch)
+        if total != batch[0]["count"]:
+            payload["batch_size"] = total
+            payload["batch_count"] = 1
+            logger.debug(f"Batching {len(batch)} text2img jobs into {total} images")
+
+        now = time.monotonic()
+        for job in batch:
+            metrics.queue_wait.observe(now - job["queued"], queue="text2img")
+
+        servers = []
+        poller = asyncio.create_task(self._poll(batch, servers))
+        request = asyncio.create_task(self.request(payload, servers.append))
+        running = {"jobs": batch, "stop": asyncio.Event()}
+        stopped = asyncio.create_task(running["stop"].wait())
+        self.batches.append(running)
+        try:
+            await asyncio.wait([request, stopped], return_when=asyncio.FIRST_COMPLETED)
+            if not request.done():
+                await self._stop(servers)
+                return
+            response = request.result()
+            images = response.get("images", [])
+            # Some backends prepend a grid of the whole batch
+            if len(images) == total + 1:
+                images = images[1:]
+            offset = 0
+            for job in batch:
+                if not job["future"].done():
+                    job["future"].set_result(images[offset:offset + job["count"]])
+                if not job["seeded"]:
+                    offset += job["count"]
+        except Exception as e:
+            for job in batch:
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+        finally:
+            # Cancelling the call closes its connection and frees the backend slot right away
+            request.cancel()
+            stopped.cancel()
+            poller.cancel()
+            self.batches.remove(running)
+
+    async def _stop(self, servers):
+        # Closing the connection doesn't stop AUTOMATIC1111, an interrupt does. Only safe on a single-slot
+        # server, which the scheduler gives to nobody else while the call holds it
+        logger.debug("Every job of a text2img batch was cancelled, stopping it")
+        if self.interrupt and servers and servers[-1].slots == 1:
+            try:
+                await self.interrupt(servers[-1])
+            except Exception as e:
+                logger.debug(f"Failed to interrupt {servers[-1].url}: {e}")
+
+    async def _poll(self, batch, servers):
+        await self._report_all(batch, "Generating...")
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            if not servers:
+                continue
+            try:
+                progress = await self.progress(servers[-1])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Failed to fetch text2img progress: {e}")
+                continue
+            percent = progress.get("progress") or 0
+            eta = progress.get("eta_relative") or 0
+            await self._report_all(batch, f"Generating... {percent:.0%} (about {eta:.0f}s left)")
+
+    async def _report_all(self, batch, text):
+        await asyncio.gather(*(self._report(job, text) for job in batch))
+
+    async def _report(self, job, text):
+        if not job["on_progress"] or job["future"].done():
+            return
+        try:
+            await job["on_progress"](text)
+        except Exception as e:
+            logger.debug(f"Failed to report text2img progress: {e}")
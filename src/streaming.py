@@ -0,0 +1,120 @@
+import time
+from . import metrics
+from .text import open_fence
+from .outbound import answer_file
+
+REST_NOTE = "*The rest of the answer is attached*"
+
+class StreamingReply:
+    # Progressively edits a reply while tokens arrive, rolling over into follow-up messages past the limit
+    def __init__(self, message, prefix="", limit=2000, interval=1.0, queue=None, max_messages=None):
+        self.message = message
+        self.queue = queue  # Optional SendQueue pacing the calls
+        self.max_messages = max_messages  # Past this many, the rest of the answer is attached to the last one
+        self.overflow = False  # The last message is full, the rest of the text waits for the attachment
+        self.limit = limit
+        self.interval = interval
+        self.prefix = prefix
+        self.text = prefix
+        self.sent_messages = []
+        self.sent_text = ""  # What the current (last) message shows
+        self.frozen = 0  # Offset of self.text already committed to earlier messages
+        self.head = ""  # Fence reopening a code block the previous message had to close
+        self.last_edit = 0.0
+
+    async def feed(self, token):
+        self.text += token
+        # The first visible token goes out immediately, later updates are throttled
+        if not self.sent_messages or time.monotonic() - self.last_edit >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        if self.overflow:
+            return
+        current = self.text[self.frozen:]
+        while len(self._content(current)) > self.limit:
+            # The last message allowed keeps room for the note about the attachment
+            last = self.max_messages and len(self.sent_messages) >= self.max_messages
+            limit = self.limit - (len(REST_NOTE) + 2 if last else 0)
+            cut = self._cut_point(current, limit - len(self.head))
+            if len(self._content(current[:cut])) > limit:
+                # Leave room for closing the code block the cut falls in
+                cut = self._cut_point(current, limit - len(self.head) - len(open_fence(self.head + current[:cut])[1]) - 1)
+            await self._show(self._content(current[:cut]))
+            # Start the next message with the remainder, inside the same code block if it was cut
+            fence, closing = open_fence(self.head + current[:cut])
+            self.head = ((fence if len(fence) <= self.limit // 4 else closing) + "\n") if fence else ""
+            self.frozen += cut
+            if last:
+                self.overflow = True
+                return
+            self.sent_text = ""
+            self.sent_messages.append(None)
+            current = self.text[self.frozen:]
+        await self._show(self._content(current))
+
+    async def _attach_rest(self):
+        last = self.sent_messages[-1]
+        content = f"{self.sent_text}\n\n{REST_NOTE}"
+        rest = answer_file((self.head + self.text[self.frozen:]).strip(), "rest")
+        await self._call("edit", lambda: last.edit(content=content, file=rest))
+        self.sent_text = content
+
+    def _content(self, body):
+        # What a message shows for this part of the text, an open code block closed so it renders
+        content = (self.head + body).strip()
+        if self.head and content == self.head.strip():
+            return ""
+        fence, closing = open_fence(content)
+        return content + "\n" + closing if fence else content
+
+    async def finish(self, fallback="(No response)"):
+        if not self.text[len(self.prefix):].strip():
+            self.text = self.prefix + fallback
+        if self.overflow:
+            await self._attach_rest()
+        else:
+            await self.flush()
+        return [m for m in self.sent_messages if m is not None]
+
+    async def abort(self, keep=True, note="*(stopped)*"):
+        # Ends a reply whose generation was cancelled: marks what was streamed so far, or deletes it
+        if keep:
+            if self.text[len(self.prefix):].strip():
+                self.text = self.text.rstrip() + f" {note}"
+                if self.overflow:
+                    await self._attach_rest()
+                else:
+                    await self.flush()
+            return [m for m in self.sent_messages if m is not None]
+        for sent in self.sent_messages:
+            if sent is not None:
+                await self._call("delete", sent.delete)
+        self.sent_messages = []
+        return []
+
+    def _cut_point(self, text, room):
+        # Prefer paragraph, then line, then word boundaries in the second half, hard-cut as a last resort
+        for sep in ("\n\n", "\n", " "):
+            cut = text.rfind(sep, 0, room)
+            if cut > room // 2:
+                return cut + len(sep)
+        return room
+
+    async def _show(self, content):
+        if not content or content == self.sent_text:
+            return
+        if not self.sent_messages:
+            self.sent_messages.append(await self._call("send", lambda: self.message.reply(content)))
+        elif self.sent_messages[-1] is None:
+            self.sent_messages[-1] = await self._call("send", lambda: self.message.channel.send(content))
+        else:
+            last = self.sent_messages[-1]
+            await self._call("edit", lambda: last.edit(content=content))
+        self.sent_text = content
+        self.last_edit = time.monotonic()
+
+    async def _call(self, operation, call):
+        if self.queue:
+            return await self.queue.run(self.message.channel.id, operation, call)
+        return await metrics.timed(metrics.discord_latency, call(), operation=operation)
@@ -0,0 +1,81 @@
+import re
+
+FENCE_PATTERN = re.compile(r"^\s*(`{3,}|~{3,})")
+WORD_PATTERN = re.compile(r"\s*\S+")
+
+def open_fence(text):
+    # Line that opened the code block still open at the end of text and the marker closing it, or (None, "")
+    fence, closing = None, ""
+    for line in text.split("\n"):
+        match = FENCE_PATTERN.match(line)
+        if match:
+            if fence is None:
+                fence, closing = line.strip(), match.group(1)
+            elif line.strip().startswith(closing):
+                fence, closing = None, ""
+    return fence, closing
+
+def split_text(text, length):
+    # Single pass over the lines: segments are filled greedily and broken between lines, code blocks
+    # are closed at a segment boundary and reopened in the next one, overlong lines are wrapped
+    # between words and words longer than a segment are hard-wrapped
+    text = text.replace("\r\n", "\n").replace("\r", "\n").strip()
+    segments = []
+    lines = []
+    size = -1  # Length of "\n".join(lines), -1 so the first line pays no separator
+    fence = None  # Line that opened the code block we're in
+    closing = ""  # Marker that closes it
+
+    def flush():
+        nonlocal lines, size
+        # A segment holding nothing but a reopened fence is not worth sending
+        if lines and not (fence and len(lines) == 1):
+            segment = "\n".join(lines)
+            if fence:
+                segment += "\n" + closing
+            segment = segment.strip()
+            if segment:
+                segments.append(segment)
+        # Very long fence lines (e.g. with attributes) are reopened as a bare marker
+        reopen = fence if fence and len(fence) <= length // 4 else closing
+        lines = [reopen] if fence else []
+        size = len(reopen) if fence else -1
+
+    def fits(extra):
+        reserve = len(closing) + 1 if fence else 0
+        return size + 1 + extra + reserve <= length
+
+    for line in text.split("\n"):
+        if not fits(len(line)):
+            flush()
+        if not fits(len(line)):
+            # Still too long on its own: fill segments word by word
+            piece = ""
+            for match in WORD_PATTERN.finditer(line):
+                word = match.group()
+                if not fits(len(piece) + len(word)):
+                    if piece:
+                        lines.append(piece)
+                        flush()
+                        piece = ""
+                    word = word.lstrip()
+                    while not fits(len(word)):
+                        cut = max(length - size - 1 - (len(closing) + 1 if fence else 0), 1)
+                        lines.append(word[:cut])
+                        flush()
+                        word = word[cut:]
+                piece += word
+            line = piece
+
+        lines.append(line)
+        size += 1 + len(line)
+
+        match = FENCE_PATTERN.match(line)
+        if match:
+            if fence is None:
+                fence, closing = line.strip(), match.group(1)
+            elif line.strip().startswith(closing):
+                fence, closing = None, ""
+
+    flush()
+    return segments
@@ -1,11 +1,18 @@
 import os
+import re
 import json
 import random
 import asyncio
+import time
 import logging
 import aiohttp
 from dotenv import load_dotenv
 from urllib.parse import urlparse, urljoin
+from .scheduler import ServerPool, RemotePool, NoServersAvailable
+from .deadlines import Deadline, DeadlineExceeded, LatencyWindow, parse_deadlines
+from .text import split_text, FENCE_PATTERN
+from .offload import loads, decode_json
+from . import metrics
 
 load_dotenv()
 
@@ -31,143 +38,417 @@ STABLE_DIFFUSION_URLS = os.getenv("STABLE_DIFFUSION", "").split(",")
 CHANNELS = os.getenv("CHANNELS", "").split(",")
 RANDOM_SERVER = os.getenv("RANDOM_SERVER", "false").lower() not in ("false", "no", "off", "0")
 
-servers = [{"url": url, "available": True} for url in OLLAMA_URLS if url]
-stable_diffusion_servers = [{"url": url, "available": True} for url in STABLE_DIFFUSION_URLS if url]
+# HTTP connection pool settings
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "8"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "0")) or None
 
-if not servers:
+# Scheduler settings
+SCHEDULER_STRATEGY = os.getenv("SCHEDULER_STRATEGY", "least_outstanding").lower()
+OLLAMA_SLOTS = [int(n) for n in os.getenv("OLLAMA_SLOTS", "1").split(",") if n]
+STABLE_DIFFUSION_SLOTS = [int(n) for n in os.getenv("STABLE_DIFFUSION_SLOTS", "1").split(",") if n]
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "30"))
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+# How long Ollama keeps a model loaded after a request ("5m", "1h", "-1" for forever), sent with every request when set
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE")
+
+def parse_duration(value, default=300.0):
+    # Seconds from Ollama's keep_alive syntax, negative means forever
+    if not value:
+        return default
+    match = re.fullmatch(r"\s*(-?[\d.]+)\s*(ms|s|m|h)?\s*", str(value))
+    if not match:
+        return default
+    seconds = float(match.group(1)) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[match.group(2) or "s"]
+    return float("inf") if seconds < 0 else seconds
+
+# Deadlines per kind of request. Generations and renders may take minutes, everything else should be quick;
+# non-streamed responses only start once they're complete, so for those first_byte bounds the whole request
+GENERATION_PATHS = ("/api/generate", "/api/chat", "/sdapi/v1/txt2img", "/sdapi/v1/img2img")
+DEADLINES = {
+    "ollama": parse_deadlines(os.getenv("OLLAMA_DEADLINES"), {"connect": HTTP_CONNECT_TIMEOUT, "first_byte": 300, "total": HTTP_TOTAL_TIMEOUT or 900}),
+    "ollama_api": parse_deadlines(os.getenv("OLLAMA_API_DEADLINES"), {"connect": HTTP_CONNECT_TIMEOUT, "first_byte": 30, "total": 60}),
+    "stable_diffusion": parse_deadlines(os.getenv("STABLE_DIFFUSION_DEADLINES"), {"connect": HTTP_CONNECT_TIMEOUT, "first_byte": 600, "total": HTTP_TOTAL_TIMEOUT or 900}),
+    "stable_diffusion_api": parse_deadlines(os.getenv("STABLE_DIFFUSION_API_DEADLINES"), {"connect": HTTP_CONNECT_TIMEOUT, "first_byte": 30, "total": 60})
+}
+# Once a request has run longer than this percentile of recent ones without answering (streams: without their
+# first token), the same request is raced on another free server and the slower copy is cancelled. 0 disables
+HEDGE_PERCENTILES = {
+    "ollama": float(os.getenv("OLLAMA_HEDGE_PERCENTILE", "0")),
+    "stable_diffusion": float(os.getenv("STABLE_DIFFUSION_HEDGE_PERCENTILE", "0"))
+}
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Set by the cluster launcher: the pools live in the launcher and workers share them through this address
+SCHEDULER_ADDRESS = os.getenv("SCHEDULER_ADDRESS")
+
+if SCHEDULER_ADDRESS:
+    ollama_pool = RemotePool("Ollama", OLLAMA_URLS, OLLAMA_SLOTS, SCHEDULER_ADDRESS)
+    stable_diffusion_pool = RemotePool("Stable Diffusion", STABLE_DIFFUSION_URLS, STABLE_DIFFUSION_SLOTS, SCHEDULER_ADDRESS)
+else:
+    ollama_pool = ServerPool(
+        "Ollama",
+        OLLAMA_URLS,
+        slots=OLLAMA_SLOTS,
+        strategy=SCHEDULER_STRATEGY,
+        health_path=os.getenv("OLLAMA_HEALTH_PATH", "/api/version"),
+        health_interval=HEALTH_CHECK_INTERVAL,
+        failure_threshold=CIRCUIT_FAILURES,
+        cooldown=CIRCUIT_COOLDOWN,
+        shuffle=RANDOM_SERVER,
+        models_path="/api/ps",
+        keep_alive=parse_duration(OLLAMA_KEEP_ALIVE)
+    )
+    stable_diffusion_pool = ServerPool(
+        "Stable Diffusion",
+        STABLE_DIFFUSION_URLS,
+        slots=STABLE_DIFFUSION_SLOTS,
+        strategy=SCHEDULER_STRATEGY,
+        health_path=os.getenv("STABLE_DIFFUSION_HEALTH_PATH", "/internal/ping"),
+        health_interval=HEALTH_CHECK_INTERVAL,
+        failure_threshold=CIRCUIT_FAILURES,
+        cooldown=CIRCUIT_COOLDOWN,
+        shuffle=RANDOM_SERVER
+    )
+
+if not ollama_pool.servers:
     logger.warning("No Ollama servers available in .env")
 
-async def make_request(path, method, data=None):
-    while not any(s["available"] for s in servers):
-        await asyncio.sleep(1)
+metrics.in_flight.collect = lambda: {
+    (name, server.url): server.outstanding
+    for pool, name in ((ollama_pool, "ollama"), (stable_diffusion_pool, "stable_diffusion"))
+    for server in pool.servers
+}
+
+# One long-lived session per backend: "ollama", "stable_diffusion" and "discord" (attachment downloads)
+sessions = {}
+
+def get_session(name):
+    # Sessions are created lazily so callers work even before open_sessions() ran
+    session = sessions.get(name)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        sessions[name] = session
+    return session
+
+async def open_sessions():
+    for name in ("ollama", "stable_diffusion", "discord"):
+        get_session(name)
+
+async def close_sessions():
+    for name, session in list(sessions.items()):
+        if not session.closed:
+            await session.close()
+        del sessions[name]
+
+health_checks = []
+
+def start_health_checks():
+    for pool, name in ((ollama_pool, "ollama"), (stable_diffusion_pool, "stable_diffusion")):
+        # Remote pools are health checked by the launcher that owns them
+        if pool.servers and HEALTH_CHECK_INTERVAL > 0 and not isinstance(pool, RemotePool):
+            health_checks.append(asyncio.create_task(pool.health_check_loop(lambda name=name: get_session(name))))
 
+def stop_health_checks():
+    while health_checks:
+        health_checks.pop().cancel()
+
+def request_model(data):
+    # Requests naming a model are routed to servers that have it loaded
+    return data.get("model") if isinstance(data, dict) else None
+
+def with_keep_alive(data):
+    if OLLAMA_KEEP_ALIVE and request_model(data):
+        # Ollama takes plain numbers as seconds but wants a unit on strings
+        keep_alive = OLLAMA_KEEP_ALIVE.strip()
+        if re.fullmatch(r"-?\d+", keep_alive):
+            keep_alive = int(keep_alive)
+        return {**data, "keep_alive": keep_alive}
+    return data
+
+latency_windows = {}  # (backend, path, model) -> LatencyWindow
+
+def request_deadlines(session_name, path):
+    if path.split("?")[0] in GENERATION_PATHS:
+        return DEADLINES[session_name]
+    return DEADLINES[session_name + "_api"]
+
+def latency_window(session_name, path, model):
+    key = (session_name, path, model)
+    window = latency_windows.get(key)
+    if window is None:
+        window = latency_windows[key] = LatencyWindow()
+    return window
+
+def hedge_delay(session_name, window):
+    percentile = HEDGE_PERCENTILES.get(session_name)
+    return window.percentile(percentile, HEDGE_MIN_SAMPLES) if percentile else None
+
+async def record_request_error(pool, session_name, server, err):
+    await pool.record_failure(server)
+    metrics.backend_errors.inc(backend=session_name, server=server.url)
+    if isinstance(err, DeadlineExceeded):
+        metrics.deadlines_missed.inc(backend=session_name, phase=err.phase)
+    log_error(err)
+
+async def request_once(pool, session_name, server, method, path, data, read, deadlines, model, window):
+    # One attempt on one server, its slot is released however it ends
+    url = server.url_for(path)
+    logger.debug(f"Making request to {url}")
+    try:
+        start = time.monotonic()
+        async with Deadline(deadlines, url) as deadline:
+            async with get_session(session_name).request(method, url, json=data, timeout=deadline.client_timeout()) as response:
+                if response.status >= 500:
+                    response.raise_for_status()
+                deadline.started()
+                pool.record_success(server, time.monotonic() - start, model)
+                result = await read(response)
+        elapsed = time.monotonic() - start
+        window.add(elapsed)
+        metrics.backend_latency.observe(elapsed, backend=session_name, server=server.url)
+        return result
+    except Exception as err:
+        await record_request_error(pool, session_name, server, err)
+        raise
+    finally:
+        await pool.release(server)
+
+async def pool_request(pool, session_name, path, method, data, read, on_server=None, sticky=None, deadlines=None):
+    # Tries each healthy server at most once, in the order the scheduler picks them. With hedging on, an
+    # attempt that runs long is raced once on another free server and the slower copy is cancelled;
+    # on_server(server) is told which server is handling the request, sticky is the URL to prefer
     error = None
-    order = list(range(len(servers)))
-    if RANDOM_SERVER:
-        random.shuffle(order)
-
-    for i in order:
-        if not servers[i]["available"]:
-            continue
-        
-        server = servers[i]
-        base_url = server["url"]
-        
-        # Ensure base_url ends with / and path doesn't start with / to avoid issues, or use proper join
-        if not base_url.endswith("/"):
-            base_url += "/"
-        if path.startswith("/"):
-            path = path[1:]
-            
-        url = base_url + path
-        
-        server["available"] = False
-        logger.debug(f"Making request to {url}")
-        
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.request(method, url, json=data) as response:
-                    response_text = await response.text()
-                    server["available"] = True
-                    # Try to parse JSON if possible, else return text
-                    try:
-                        return json.loads(response_text)
-                    except json.JSONDecodeError:
-                        return response_text
-        except Exception as err:
-            server["available"] = True
-            error = err
-            log_error(err)
+    tried = []
+    model = request_model(data)
+    deadlines = {**request_deadlines(session_name, path), **(deadlines or {})}
+    window = latency_window(session_name, path, model)
+    running = {}  # Task -> "primary" or "hedge"
+    may_hedge = True
+    hedged = False
+
+    def start(server, role):
+        tried.append(server)
+        if on_server:
+            on_server(server)
+        running[asyncio.create_task(request_once(pool, session_name, server, method, path, data, read, deadlines, model, window))] = role
+
+    try:
+        while True:
+            if not running:
+                try:
+                    start(await pool.acquire(tried, model, sticky), "primary")
+                except NoServersAvailable:
+                    break
+            delay = hedge_delay(session_name, window) if may_hedge else None
+            done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Slower than most: a busy pool is not waited on, the hedge is only worth it on a free server
+                may_hedge = False
+                try:
+                    start(await pool.acquire(tried, model, sticky, wait=False), "hedge")
+                    hedged = True
+                except NoServersAvailable:
+                    pass
+                continue
+            for task in done:
+                role = running.pop(task)
+                if task.exception() is None:
+                    if hedged:
+                        metrics.hedged_requests.inc(backend=session_name, winner=role)
+                    return task.result()
+                error = task.exception()
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
             
     if not error:
         raise Exception("No servers available")
     raise error
 
-async def make_stable_diffusion_request(path, method, data=None):
-    while not any(s["available"] for s in stable_diffusion_servers):
-        await asyncio.sleep(1)
+async def read_json_or_text(response):
+    response_text = await response.text()
+    # Try to parse JSON if possible, else return text; long contexts make for big documents
+    try:
+        return await decode_json(response_text)
+    except json.JSONDecodeError:
+        return response_text
+
+async def read_json(response):
+    # txt2img responses carry every image as base64
+    return await decode_json(await response.read())
+
+async def make_request(path, method, data=None, sticky=None, on_server=None, deadlines=None):
+    # deadlines overrides the configured ones for this call, e.g. {"total": 20}
+    return await pool_request(ollama_pool, "ollama", path, method, with_keep_alive(data), read_json_or_text, on_server, sticky, deadlines)
+
+async def get_embedding(model, text):
+    response = await make_request("/api/embeddings", "post", {"model": model, "prompt": text})
+    if not isinstance(response, dict) or "embedding" not in response:
+        raise Exception(f"Unexpected embeddings response: {str(response)[:200]}")
+    return response["embedding"]
+
+async def stream_once(server, method, path, data, deadlines, model, window, queue):
+    # Feeds one attempt's objects into the queue, None marks its end however it ends
+    url = server.url_for(path)
+    logger.debug(f"Making streaming request to {url}")
+    try:
+        start = time.monotonic()
+        async with Deadline(deadlines, url) as deadline:
+            def put(line):
+                # For a stream the first byte that counts is the first token
+                if deadline.phase == "first_byte":
+                    deadline.started()
+                    window.add(time.monotonic() - start)
+                queue.put_nowait(loads(line))
 
+            async with get_session("ollama").request(method, url, json=data, timeout=deadline.client_timeout()) as response:
+                response.raise_for_status()
+                ollama_pool.record_success(server, time.monotonic() - start, model)
+                buffer = b""
+                async for chunk in response.content.iter_any():
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        if line.strip():
+                            put(line)
+                if buffer.strip():
+                    put(buffer)
+        metrics.backend_latency.observe(time.monotonic() - start, backend="ollama", server=server.url)
+    except Exception as err:
+        await record_request_error(ollama_pool, "ollama", server, err)
+        raise
+    finally:
+        queue.put_nowait(None)
+        await ollama_pool.release(server)
+
+async def stream_request(path, method, data=None, sticky=None, on_server=None, deadlines=None):
+    # Yields each JSON object of an NDJSON response (Ollama "stream": true) as it arrives. Attempts run as
+    # tasks feeding queues so a stream slow to start can be hedged like pool_request does; the first one
+    # to produce an object wins
     error = None
-    order = list(range(len(stable_diffusion_servers)))
-    if RANDOM_SERVER:
-        random.shuffle(order)
+    tried = []
+    data = with_keep_alive(data)
+    model = request_model(data)
+    deadlines = {**request_deadlines("ollama", path), **(deadlines or {})}
+    window = latency_window("ollama", path, model)
+    running = {}  # First queue.get() -> (task, queue, "primary" or "hedge")
+    may_hedge = True
+    hedged = False
+    winner = None
 
-    for i in order:
-        if not stable_diffusion_servers[i]["available"]:
-            continue
-            
-        server = stable_diffusion_servers[i]
-        base_url = server["url"]
-        
-        if not base_url.endswith("/"):
-            base_url += "/"
-        if path.startswith("/"):
-            path = path[1:]
-            
-        url = base_url + path
-        
-        server["available"] = False
-        logger.debug(f"Making stable diffusion request to {url}")
-        
+    def start(server, role):
+        tried.append(server)
+        if on_server:
+            on_server(server)
+        queue = asyncio.Queue()
+        task = asyncio.create_task(stream_once(server, method, path, data, deadlines, model, window, queue))
+        running[asyncio.ensure_future(queue.get())] = (task, queue, role)
+
+    try:
+        while winner is None:
+            if not running:
+                try:
+                    start(await ollama_pool.acquire(tried, model, sticky), "primary")
+                except NoServersAvailable:
+                    break
+            delay = hedge_delay("ollama", window) if may_hedge else None
+            done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                may_hedge = False
+                try:
+                    start(await ollama_pool.acquire(tried, model, sticky, wait=False), "hedge")
+                    hedged = True
+                except NoServersAvailable:
+                    pass
+                continue
+            for getter in done:
+                task, queue, role = running.pop(getter)
+                first = getter.result()
+                if first is not None:
+                    if hedged:
+                        metrics.hedged_requests.inc(backend="ollama", winner=role)
+                    winner = (task, queue, first)
+                    break
+                # Ended before its first object: either an error or an empty response
+                try:
+                    await task
+                except Exception as err:
+                    error = err
+                else:
+                    return
+
+        if winner is None:
+            if not error:
+                raise Exception("No servers available")
+            raise error
+
+        # Part of the answer is handed out from here on, a failure can't be retried without duplicating it
+        for getter, (task, _, _) in running.items():
+            getter.cancel()
+            task.cancel()
+        task, queue, first = winner
+        yield first
+        while (obj := await queue.get()) is not None:
+            yield obj
+        await task
+    finally:
+        for getter, (task, _, _) in running.items():
+            getter.cancel()
+            task.cancel()
+        if winner:
+            winner[0].cancel()
+        tasks = [task for task, _, _ in running.values()] + ([winner[0]] if winner else [])
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def preload_models(models):
+    # Loads the models on every Ollama server that doesn't have them yet, an empty prompt only loads the model
+    async def load(server, model):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.request(method, url, json=data) as response:
-                    result = await response.json()
-                    server["available"] = True
-                    return result
-        except Exception as err:
-            server["available"] = True
-            error = err
-            log_error(err)
+            async with get_session("ollama").post(server.url_for("/api/generate"), json=with_keep_alive({"model": model})) as response:
+                response.raise_for_status()
+                await response.read()
+            ollama_pool.record_model(server, model)
+            logger.info(f"Preloaded {model} on {server.url}")
+        except Exception as e:
+            logger.warning(f"Failed to preload {model} on {server.url}: {e}")
 
-    if not error:
-        raise Exception("No servers available")
-    raise error
+    await ollama_pool.check_health(get_session("ollama"))
+    await asyncio.gather(*(load(server, model) for server in ollama_pool.servers for model in models if server.healthy and not server.has_model(model)))
 
-def split_text(text, length):
-    # Normalize newlines
-    text = text.replace("\r\n", "\n").replace("\r", "\n").strip()
-    segments = []
-    segment = ""
-    
-    # Simple word-based splitting to match the logic roughly
-    # The original logic is quite complex with regex. 
-    # We will implement a robust splitter.
-    
-    import re
-    words = re.split(r'([^\s]+(?:\s+|$))', text)
-    # Filter empty strings from split
-    words = [w for w in words if w]
-
-    for word in words:
-        if len(segment) + len(word) > length:
-            # Prioritize splitting by newlines if present in the current segment
-            if "\n" in segment:
-                before_paragraph = re.match(r'^.*\n', segment, re.DOTALL)
-                if before_paragraph:
-                    bp = before_paragraph.group(0)
-                    last_paragraph = segment[len(bp):]
-                    segments.append(bp.strip())
-                    segment = last_paragraph + word
-                    continue
-            
-            if segment.strip():
-                segments.append(segment.strip())
-            segment = ""
-            
-            # If word itself is too long
-            if len(word) > length:
-                # Just cut it for now, original logic had hyphenation attempt
-                # We'll just add it as is (it will be split in next iteration or we force split)
-                # But here we just append to empty segment
-                pass
-        
-        segment += word
-        
-    if segment.strip():
-        segments.append(segment.strip())
-        
-    return segments
+async def make_stable_diffusion_request(path, method, data=None, on_server=None, deadlines=None):
+    return await pool_request(stable_diffusion_pool, "stable_diffusion", path, method, data, read_json, on_server, deadlines=deadlines)
+
+async def get_stable_diffusion_progress(server):
+    # Progress of whatever the server is rendering right now, without taking one of its slots
+    async with get_session("stable_diffusion").get(server.url_for("/sdapi/v1/progress?skip_current_image=true")) as response:
+        response.raise_for_status()
+        return await response.json()
+
+async def get_stable_diffusion_options(server):
+    # The server's settings (e.g. the loaded checkpoint), also without taking a slot
+    async with get_session("stable_diffusion").get(server.url_for("/sdapi/v1/options")) as response:
+        response.raise_for_status()
+        return await response.json()
+
+async def interrupt_stable_diffusion(server):
+    # Stops whatever the server is rendering right now, the call that started it returns what it has so far
+    async with get_session("stable_diffusion").post(server.url_for("/sdapi/v1/interrupt")) as response:
+        response.raise_for_status()
 
 def get_boolean(val):
     if val is None: return False
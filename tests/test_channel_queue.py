@@ -0,0 +1,57 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from src.channel_queue import ChannelQueue
+
+def make_job(message_id, reply_to=None):
+    return {"message": SimpleNamespace(id=message_id, author=SimpleNamespace(id=1, name="user")), "input": str(message_id), "reply_to": reply_to}
+
+class CancelDuringDebounceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.batches = []
+
+        async def handler(channel_id, jobs):
+            self.batches.append([job["message"].id for job in jobs])
+
+        self.queue = ChannelQueue(handler, debounce=0.2, max_batch=4)
+
+    async def test_cancelling_every_pending_job_ends_the_worker_cleanly(self):
+        self.queue.put(1, make_job(1))
+        worker = self.queue.channels[1]["worker"]
+        await asyncio.sleep(0.05)
+        dropped = self.queue.cancel(1, {1})
+
+        await asyncio.wait_for(worker, 1)
+        self.assertEqual([job["message"].id for job in dropped], [1])
+        self.assertIsNone(worker.exception())
+        self.assertEqual(self.batches, [])
+        self.assertNotIn(1, self.queue.channels)
+
+        # The channel takes new messages afterwards
+        self.queue.put(1, make_job(2))
+        await asyncio.wait_for(self.queue.channels[1]["worker"], 1)
+        self.assertEqual(self.batches, [[2]])
+
+    async def test_cancelling_the_whole_channel_during_debounce(self):
+        self.queue.put(1, make_job(1))
+        self.queue.put(1, make_job(2))
+        worker = self.queue.channels[1]["worker"]
+        await asyncio.sleep(0.05)
+        self.queue.cancel(1)
+
+        await asyncio.wait_for(worker, 1)
+        self.assertIsNone(worker.exception())
+        self.assertEqual(self.batches, [])
+
+    async def test_jobs_left_after_a_cancel_are_still_answered(self):
+        self.queue.put(1, make_job(1))
+        self.queue.put(1, make_job(2))
+        worker = self.queue.channels[1]["worker"]
+        await asyncio.sleep(0.05)
+        self.queue.cancel(1, {1})
+
+        await asyncio.wait_for(worker, 1)
+        self.assertEqual(self.batches, [[2]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from src.context_store import ContextStore
+
+class PendingWritesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "contexts.db")
+        self.stores = []
+        self.blockers = []
+
+    def tearDown(self):
+        for blocker in self.blockers:
+            blocker.close()
+        for store in self.stores:
+            store.close()
+        self.dir.cleanup()
+
+    def open_store(self, **kwargs):
+        store = ContextStore(path=self.path, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def hold_writes(self):
+        # Another worker holding the write lock keeps the store's writes queued
+        blocker = sqlite3.connect(self.path, check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE")
+        self.blockers.append(blocker)
+        return blocker
+
+    def test_reset_while_the_delete_is_pending(self):
+        store = self.open_store()
+        store.save_turn(1, [10], [1, 2, 3])
+        store.close()
+
+        blocker = self.hold_writes()
+        self.assertEqual(store.clear(1), 1)
+        # The rows are still on disk, but must not be read back
+        self.assertEqual(store.amount(1), 0)
+        self.assertIsNone(store.turn_of(1, 10))
+        self.assertIsNone(store.get(1))
+        blocker.rollback()
+        store.close()
+
+        self.assertEqual(store.amount(1), 0)
+        self.assertIsNone(store.get(1, 10))
+        self.assertEqual(self.open_store().amount(1), 0)
+
+    def test_new_turn_after_a_pending_reset(self):
+        store = self.open_store()
+        store.save_turn(1, [10], [1, 2, 3])
+        store.close()
+
+        blocker = self.hold_writes()
+        store.clear(1)
+        store.save_turn(1, [20], [4, 5])
+        self.assertEqual(store.amount(1), 1)
+        self.assertIsNone(store.turn_of(1, 10))
+        blocker.rollback()
+        store.close()
+
+        reopened = self.open_store()
+        self.assertEqual(reopened.amount(1), 1)
+        self.assertEqual(reopened.get(1, 20), [4, 5])
+        self.assertIsNone(reopened.get(1, 10))
+
+    def test_unwritten_turns_are_not_evicted(self):
+        store = self.open_store(memory_budget=1)
+        blocker = self.hold_writes()
+        store.save_turn(1, [10], list(range(1000)))
+        store.save_turn(2, [20], list(range(500)))
+        self.assertEqual(store.get(1, 10), list(range(1000)))
+        self.assertEqual(store.get(2), list(range(500)))
+        blocker.rollback()
+        store.close()
+
+        # Once written they can go, and are reloaded from disk
+        store.expire()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.get(1, 10), list(range(1000)))
+
+    def test_evicted_turns_take_their_refs_along(self):
+        store = self.open_store(memory_budget=1)
+        for turn in range(10):
+            store.save_turn(1, [turn * 10, turn * 10 + 1], [turn] * 300)
+            store.close()
+        store.expire()
+        self.assertEqual(store.channels[1]["refs"], {})
+        # Reloaded from disk when asked for
+        self.assertEqual(store.get(1, 31), [3] * 300)
+        self.assertEqual(store.turn_of(1), 90)
+
+if __name__ == "__main__":
+    unittest.main()